@@ -8,3 +8,8 @@ USERS = {
 
 # Tag for advertising, obtainable from @MTProxybot
 # AD_TAG = "3c09c680b76ee91a4c25ad51f742267d"
+
+# Max bytes per second for each user, the traffic in both directions is counted
+# USER_BANDWIDTH_LIMITS = {
+#     "tg": 1000000
+# }
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Summarizes the connection events written with EVENT_LOG_FILE
+#
+# python3 eventlog.py events.log
+# python3 eventlog.py events.log --since 3600 --json
+
+import argparse
+import collections
+import json
+import struct
+import time
+
+# the format of EventLog in mtprotoproxy.py, which is not imported because it
+# needs config.py and sets up the proxy on import
+MAGIC = b"MTPEVLOG"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<dIBBh16sQQf")
+
+OPEN, REJECTED, CLOSE = range(3)
+REASONS = ["", "bad", "replayed", "banned", "shed", "user_limit", "timeout",
+           "dc_failed", "client_closed", "dc_closed", "error", "bad_proxy_header"]
+
+
+def get_percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, len(sorted_values) * percent // 100)
+    return sorted_values[idx]
+
+
+def read_events(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, written = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("%s is not an event log" % path)
+
+    records = (len(data) - HEADER.size) // RECORD.size
+    # the oldest record is right after the newest one when the ring is full
+    for idx in range(max(written - records, 0), written):
+        offset = HEADER.size + RECORD.size * (idx % records)
+        yield RECORD.unpack_from(data, offset)
+
+
+def new_summary():
+    return {"opened": 0, "closed": 0, "close_reasons": collections.Counter(),
+            "octets_from_client": 0, "octets_to_client": 0, "durations": []}
+
+
+def summarize(events, since=0):
+    by_user = collections.defaultdict(new_summary)
+    by_dc = collections.defaultdict(new_summary)
+    rejected = collections.Counter()
+
+    for timestamp, conn_id, event_type, reason, dc_idx, user, octets_from_clt, \
+            octets_to_clt, duration in events:
+        if timestamp < since:
+            continue
+        reason = REASONS[reason]
+        if event_type == REJECTED:
+            rejected[reason] += 1
+            continue
+
+        summaries = [by_user[user.rstrip(b"\0").decode(errors="replace")], by_dc[dc_idx]]
+        for summary in summaries:
+            if event_type == OPEN:
+                summary["opened"] += 1
+            elif event_type == CLOSE:
+                summary["closed"] += 1
+                summary["close_reasons"][reason] += 1
+                summary["octets_from_client"] += octets_from_clt
+                summary["octets_to_client"] += octets_to_clt
+                summary["durations"].append(duration)
+
+    for summary in list(by_user.values()) + list(by_dc.values()):
+        durations = sorted(summary.pop("durations"))
+        summary["duration_p50"] = get_percentile(durations, 50)
+        summary["duration_p99"] = get_percentile(durations, 99)
+
+    return {"users": dict(by_user), "dcs": dict(by_dc), "rejected": rejected}
+
+
+def print_summary(summary):
+    print("Rejected:", ", ".join("%d %s" % (count, reason)
+                                 for reason, count in summary["rejected"].most_common()) or "none")
+    for title, rows in [("User", summary["users"]), ("DC", summary["dcs"])]:
+        print()
+        print("%-16s %8s %8s %12s %12s %10s %10s  %s" % (
+            title, "opened", "closed", "MB from clt", "MB to clt", "p50 dur", "p99 dur",
+            "close reasons"))
+        for name, row in sorted(rows.items()):
+            print("%-16s %8d %8d %12.2f %12.2f %9.1fs %9.1fs  %s" % (
+                name, row["opened"], row["closed"], row["octets_from_client"] / 1000000,
+                row["octets_to_client"] / 1000000, row["duration_p50"], row["duration_p99"],
+                ", ".join("%d %s" % (count, reason)
+                          for reason, count in row["close_reasons"].most_common())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the proxy connection events")
+    parser.add_argument("event_log", help="the file written with EVENT_LOG_FILE")
+    parser.add_argument("--since", type=float, default=0,
+                        help="use only the events of the last that many seconds")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+
+    since = time.time() - args.since if args.since else 0
+    summary = summarize(read_events(args.event_log), since)
+
+    if args.json:
+        print(json.dumps(summary, indent=4, sort_keys=True, default=str))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
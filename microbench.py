@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks for the proxy building blocks, every result is in operations
+# or bytes per second, so the bigger is the better
+#
+# python3 microbench.py --output results.json
+# python3 microbench.py --baseline results.json --threshold 0.1
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+
+import mtprotoproxy
+import pyaes
+
+MIN_TIME = 0.3
+CHUNK_SIZES = [64, 1024, 16384]
+USERS_COUNTS = [1, 10, 100, 1000, 10000]
+
+
+def measure(func, min_time=MIN_TIME):
+    # returns calls per second
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def measure_async(coro_func, min_time=MIN_TIME):
+    loop = asyncio.new_event_loop()
+    try:
+        return measure(lambda: loop.run_until_complete(coro_func()), min_time)
+    finally:
+        loop.close()
+
+
+def get_crypto_backends():
+    backends = {
+        "pyaes": (
+            lambda key, iv: pyaes.AESModeOfOperationCTR(key, pyaes.Counter(iv)),
+            lambda key, iv: PyaesCbc(key, iv)
+        )
+    }
+    try:
+        from Crypto.Cipher import AES
+        from Crypto.Util import Counter
+
+        backends["pycrypto"] = (
+            lambda key, iv: AES.new(key, AES.MODE_CTR, counter=Counter.new(128, initial_value=iv)),
+            lambda key, iv: AES.new(key, AES.MODE_CBC, iv)
+        )
+    except ImportError:
+        pass
+    return backends
+
+
+class PyaesCbc:
+    def __init__(self, key, iv):
+        self.mode = pyaes.AESModeOfOperationCBC(key, iv)
+
+    def encrypt(self, data):
+        return self.mode.encrypt_blocks(data)
+
+
+def bench_crypto():
+    results = {}
+    key, iv = os.urandom(32), os.urandom(16)
+    for backend, (create_ctr, create_cbc) in get_crypto_backends().items():
+        for chunk_size in CHUNK_SIZES:
+            data = os.urandom(chunk_size)
+
+            ctr = create_ctr(key, int.from_bytes(iv, "big"))
+            speed = measure(lambda: ctr.encrypt(data)) * chunk_size
+            results["crypto.%s.ctr.%d" % (backend, chunk_size)] = speed
+
+            cbc = create_cbc(key, iv)
+            speed = measure(lambda: cbc.encrypt(data)) * chunk_size
+            results["crypto.%s.cbc.%d" % (backend, chunk_size)] = speed
+
+            # the direct mode relay: decrypting from one side and encrypting to the other
+            decryptor = create_ctr(key, int.from_bytes(iv, "big"))
+            encryptor = create_ctr(key[::-1], int.from_bytes(iv[::-1], "big"))
+            speed = measure(lambda: encryptor.encrypt(decryptor.decrypt(data))) * chunk_size
+            results["crypto.%s.reencrypt.%d" % (backend, chunk_size)] = speed
+
+            keystream = mtprotoproxy.CombinedKeystream(
+                create_ctr(key, int.from_bytes(iv, "big")),
+                create_ctr(key[::-1], int.from_bytes(iv[::-1], "big")))
+            speed = measure(lambda: keystream.transcode(data)) * chunk_size
+            results["crypto.%s.fused_reencrypt.%d" % (backend, chunk_size)] = speed
+    return results
+
+
+class FakeReader:
+    def __init__(self, data):
+        self.data = data
+
+    async def readexactly(self, n):
+        ret, self.data = self.data[:n], self.data[n:]
+        return ret
+
+
+class FakeWriter:
+    def __init__(self):
+        self.written = 0
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 12345) if name == "peername" else None
+
+    def write(self, data):
+        self.written += len(data)
+
+    async def drain(self):
+        pass
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_handshake(secret, dc=2):
+    handshake = bytearray(os.urandom(mtprotoproxy.HANDSHAKE_LEN))
+    handshake[mtprotoproxy.MAGIC_VAL_POS:mtprotoproxy.MAGIC_VAL_POS+4] = (
+        mtprotoproxy.MAGIC_VAL_TO_CHECK)
+    handshake[60:62] = int.to_bytes(dc, 2, "little")
+
+    prekey_and_iv = bytes(handshake[8:56])
+    key = hashlib.sha256(prekey_and_iv[:32] + secret).digest()
+    encryptor = mtprotoproxy.create_aes_ctr(key, int.from_bytes(prekey_and_iv[32:], "big"))
+    encrypted = encryptor.encrypt(bytes(handshake))
+    return bytes(handshake[:56]) + encrypted[56:]
+
+
+def bench_handshake():
+    results = {}
+
+    # repeated handshakes should not be rejected as replays or bans
+    mtprotoproxy.replay_filter = None
+    mtprotoproxy.failed_handshakes.fails_before_ban = 0
+
+    for users_count in USERS_COUNTS:
+        users = {"user%d" % i: os.urandom(16).hex() for i in range(users_count)}
+        mtprotoproxy.USERS = users
+        mtprotoproxy.init_stats()
+
+        # the worst case for the valid secret is the last user
+        last_secret = bytes.fromhex(users["user%d" % (users_count - 1)])
+        good_handshake = make_handshake(last_secret)
+        bad_handshake = os.urandom(mtprotoproxy.HANDSHAKE_LEN)
+
+        async def do_good():
+            ret = await mtprotoproxy.handle_handshake(FakeReader(good_handshake), FakeWriter())
+            mtprotoproxy.update_stats(ret[2], curr_connects_x2=-2)
+
+        async def do_bad():
+            await mtprotoproxy.handle_handshake(FakeReader(bad_handshake), FakeWriter())
+
+        min_time = MIN_TIME if users_count < 1000 else MIN_TIME * 3
+        results["handshake.good.%d_users" % users_count] = measure_async(do_good, min_time)
+        results["handshake.bad.%d_users" % users_count] = measure_async(do_bad, min_time)
+    return results
+
+
+def make_stream_reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+def bench_framing():
+    results = {}
+    msgs_count = 1000
+    msg = os.urandom(128)
+
+    for name, writer_class in [("frame", mtprotoproxy.MTProtoFrameStreamWriter),
+                               ("compact_frame", mtprotoproxy.MTProtoCompactFrameStreamWriter),
+                               ("proxy_req", mtprotoproxy.ProxyReqStreamWriter)]:
+        def write_msgs():
+            writer = writer_class(FakeWriter())
+            for i in range(msgs_count):
+                writer.write(msg)
+        results["framing.%s_writer" % name] = measure(write_msgs) * msgs_count
+
+    class CollectingWriter(FakeWriter):
+        def __init__(self):
+            self.data = bytearray()
+
+        def write(self, data):
+            self.data += data
+
+    frames = CollectingWriter()
+    writer = mtprotoproxy.MTProtoFrameStreamWriter(frames)
+    compact_frames = CollectingWriter()
+    compact_writer = mtprotoproxy.MTProtoCompactFrameStreamWriter(compact_frames)
+    for i in range(msgs_count):
+        writer.write(msg)
+        compact_writer.write(msg)
+
+    for name, reader_class, data in [
+            ("frame", mtprotoproxy.MTProtoFrameStreamReader, bytes(frames.data)),
+            ("compact_frame", mtprotoproxy.MTProtoCompactFrameStreamReader,
+             bytes(compact_frames.data))]:
+        async def read_msgs():
+            reader = reader_class(make_stream_reader(data))
+            for i in range(msgs_count):
+                await reader.read(1)
+        results["framing.%s_reader" % name] = measure_async(read_msgs) * msgs_count
+    return results
+
+
+def bench_relay():
+    results = {}
+    mtprotoproxy.init_stats()
+
+    for chunk_size in CHUNK_SIZES:
+        chunks_count = max(1, 1000000 // chunk_size)
+        data = os.urandom(chunk_size) * chunks_count
+
+        async def relay():
+            reader = make_stream_reader(data)
+            conn = mtprotoproxy.ClientConnection("bench", 1, "127.0.0.1")
+            conn.relays_alive = 1
+            mtprotoproxy.update_stats("bench", curr_connects_x2=1)
+            await mtprotoproxy.connect_reader_to_writer(reader, FakeWriter(), conn, to_clt=True)
+
+        saved_buf_size = mtprotoproxy.READ_BUF_SIZE
+        mtprotoproxy.READ_BUF_SIZE = chunk_size
+        try:
+            results["relay.%d" % chunk_size] = measure_async(relay) * len(data)
+        finally:
+            mtprotoproxy.READ_BUF_SIZE = saved_buf_size
+
+    results.update(bench_crypto_relay())
+    return results
+
+
+def bench_crypto_relay():
+    # the direct mode relay with the proxy's aes, reencrypting or fused
+    results = {}
+    key, iv = os.urandom(32), int.from_bytes(os.urandom(16), "big")
+
+    def make_reencrypting(reader, writer):
+        reader = mtprotoproxy.CryptoWrappedStreamReader(
+            reader, mtprotoproxy.create_aes_ctr(key, iv))
+        writer = mtprotoproxy.CryptoWrappedStreamWriter(
+            writer, mtprotoproxy.create_aes_ctr(key[::-1], iv))
+        return reader, writer
+
+    def make_fused(reader, writer):
+        return mtprotoproxy.fuse_reencryption(*make_reencrypting(reader, writer))
+
+    for chunk_size in CHUNK_SIZES:
+        # the slow aes is too slow for megabytes
+        chunks_count = max(1, 65536 // chunk_size)
+        data = os.urandom(chunk_size) * chunks_count
+
+        for name, make_streams in [("reencrypt", make_reencrypting), ("fused", make_fused)]:
+            async def relay():
+                reader, writer = make_streams(make_stream_reader(data), FakeWriter())
+                conn = mtprotoproxy.ClientConnection("bench", 1, "127.0.0.1")
+                conn.relays_alive = 1
+                mtprotoproxy.update_stats("bench", curr_connects_x2=1)
+                await mtprotoproxy.connect_reader_to_writer(reader, writer, conn, to_clt=True)
+
+            saved_buf_size = mtprotoproxy.READ_BUF_SIZE
+            mtprotoproxy.READ_BUF_SIZE = chunk_size
+            try:
+                speed = measure_async(relay) * len(data)
+                results["relay.%s.%d" % (name, chunk_size)] = speed
+            finally:
+                mtprotoproxy.READ_BUF_SIZE = saved_buf_size
+    return results
+
+
+BENCHMARKS = {
+    "crypto": bench_crypto,
+    "handshake": bench_handshake,
+    "framing": bench_framing,
+    "relay": bench_relay,
+}
+
+
+def compare_with_baseline(results, baseline, threshold):
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = value / baseline[name] if baseline[name] else 1
+        mark = ""
+        if ratio < 1 - threshold:
+            mark = "  REGRESSION"
+            regressions.append(name)
+        print("%-45s %14.1f %14.1f %6.2fx%s" % (name, baseline[name], value, ratio, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for mtprotoproxy")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run: %s, all by default" % ", ".join(BENCHMARKS))
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--baseline", help="compare the results with this json file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="the allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results.update(BENCHMARKS[name]())
+
+    for name, value in sorted(results.items()):
+        print("%-45s %14.1f" % (name, value))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions:", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
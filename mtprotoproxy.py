@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import array
 import asyncio
 import socket
 import urllib.parse
@@ -7,8 +8,20 @@ import urllib.request
 import collections
 import time
 import hashlib
+import ipaddress
 import random
 import binascii
+import concurrent.futures
+import itertools
+import json
+import mmap
+import os
+import queue
+import signal
+import struct
+import sys
+import threading
+import tracemalloc
 
 try:
     from Crypto.Cipher import AES
@@ -21,10 +34,14 @@ try:
     def create_aes_cbc(key, iv):
         return AES.new(key, AES.MODE_CBC, iv)
 
+    SLOW_AES = False
+
 except ImportError:
     print("Failed to find pycrypto, using slow AES version", flush=True)
     import pyaes
 
+    SLOW_AES = True
+
     def create_aes_ctr(key, iv):
         ctr = pyaes.Counter(iv)
         return pyaes.AESModeOfOperationCTR(key, ctr)
@@ -35,12 +52,10 @@ except ImportError:
                 self.mode = mode
 
             def encrypt(self, data):
-                encrypter = pyaes.Encrypter(self.mode, pyaes.PADDING_NONE)
-                return encrypter.feed(data) + encrypter.feed()
+                return self.mode.encrypt_blocks(data)
 
             def decrypt(self, data):
-                decrypter = pyaes.Decrypter(self.mode, pyaes.PADDING_NONE)
-                return decrypter.feed(data) + decrypter.feed()
+                return self.mode.decrypt_blocks(data)
 
         mode = pyaes.AESModeOfOperationCBC(key, iv)
         return EncryptorAdapter(mode)
@@ -57,6 +72,158 @@ FAST_MODE = getattr(config, "FAST_MODE", True)
 STATS_PRINT_PERIOD = getattr(config, "STATS_PRINT_PERIOD", 600)
 READ_BUF_SIZE = getattr(config, "READ_BUF_SIZE", 4096)
 AD_TAG = bytes.fromhex(getattr(config, "AD_TAG", ""))
+# decrypt and reencrypt direct mode traffic in one pass, it is slower than two passes
+# with the common aes backends, compare with "python3 microbench.py crypto relay" first
+FUSED_REENCRYPTION = getattr(config, "FUSED_REENCRYPTION", False)
+# encrypt large chunks in worker threads to keep the event loop responsive
+CRYPTO_OFFLOAD = getattr(config, "CRYPTO_OFFLOAD", SLOW_AES)
+# chunks smaller than this are always encrypted inline
+CRYPTO_OFFLOAD_THRESHOLD = getattr(config, "CRYPTO_OFFLOAD_THRESHOLD", 2048)
+CRYPTO_OFFLOAD_WORKERS = getattr(config, "CRYPTO_OFFLOAD_WORKERS", 2)
+# how many keystream bytes to generate ahead in the worker threads, without
+# CRYPTO_OFFLOAD it is generated in the event loop, so keep it small then
+KEYSTREAM_PREFETCH_SIZE = getattr(config, "KEYSTREAM_PREFETCH_SIZE",
+                                  4 * READ_BUF_SIZE if SLOW_AES and CRYPTO_OFFLOAD else 0)
+# reject handshakes seen during the last REPLAY_CHECK_WINDOW seconds
+REPLAY_CHECK = getattr(config, "REPLAY_CHECK", True)
+REPLAY_CHECK_WINDOW = getattr(config, "REPLAY_CHECK_WINDOW", 3600)
+# the size of each of the two bloom filters, in bits
+REPLAY_CHECK_BITS = getattr(config, "REPLAY_CHECK_BITS", 2 ** 24)
+# ban ips after this number of failed handshakes in a row, 0 disables
+# ipv6 clients are banned by /64 networks. All clients behind one ip, like a carrier
+# nat or a balancer without PROXY_PROTOCOL, share a ban, and the handshakes of a
+# banned ip are not checked, so one client with a wrong secret locks out all of them
+BAN_AFTER_FAILED_HANDSHAKES = getattr(config, "BAN_AFTER_FAILED_HANDSHAKES", 0)
+# the ban time doubles for every next failure, in seconds
+BAN_MIN_TIME = getattr(config, "BAN_MIN_TIME", 1)
+BAN_MAX_TIME = getattr(config, "BAN_MAX_TIME", 600)
+# how many ips with failures to remember, the least recently failed are forgotten
+BAN_MAX_TRACKED_IPS = getattr(config, "BAN_MAX_TRACKED_IPS", 100000)
+# max number of clients in the handshake stage, 0 is unlimited
+MAX_HANDSHAKES_IN_FLIGHT = getattr(config, "MAX_HANDSHAKES_IN_FLIGHT", 1024)
+# max number of simultaneous connects to telegram, 0 is unlimited
+MAX_UPSTREAM_CONNECTS = getattr(config, "MAX_UPSTREAM_CONNECTS", 512)
+# clients over the limits wait in a queue, when it is full they are dropped
+ACCEPT_QUEUE_SIZE = getattr(config, "ACCEPT_QUEUE_SIZE", 4096)
+ACCEPT_QUEUE_TIMEOUT = getattr(config, "ACCEPT_QUEUE_TIMEOUT", 5)
+# the limits are lowered proportionally when the loop lag is above this, in seconds
+OVERLOAD_LOOP_LAG = getattr(config, "OVERLOAD_LOOP_LAG", 0.1)
+CLIENT_HANDSHAKE_TIMEOUT = getattr(config, "CLIENT_HANDSHAKE_TIMEOUT", 10)
+# user -> max bytes per second of user traffic in both directions
+USER_BANDWIDTH_LIMITS = getattr(config, "USER_BANDWIDTH_LIMITS", {})
+# limit for users not in USER_BANDWIDTH_LIMITS, 0 is unlimited
+DEFAULT_USER_BANDWIDTH_LIMIT = getattr(config, "DEFAULT_USER_BANDWIDTH_LIMIT", 0)
+# max bytes per second of one client connection, 0 is unlimited
+CONNECTION_BANDWIDTH_LIMIT = getattr(config, "CONNECTION_BANDWIDTH_LIMIT", 0)
+# the uplink capacity in bytes per second, if set, it is shared fairly between users
+EGRESS_BANDWIDTH = getattr(config, "EGRESS_BANDWIDTH", 0)
+EGRESS_QUANTUM = getattr(config, "EGRESS_QUANTUM", READ_BUF_SIZE)
+# user -> max number of simultaneous connections
+USER_MAX_CONNECTIONS = getattr(config, "USER_MAX_CONNECTIONS", {})
+DEFAULT_USER_MAX_CONNECTIONS = getattr(config, "DEFAULT_USER_MAX_CONNECTIONS", 0)
+# user -> max number of new connections per second
+USER_MAX_CONNECTS_PER_SEC = getattr(config, "USER_MAX_CONNECTS_PER_SEC", {})
+DEFAULT_USER_MAX_CONNECTS_PER_SEC = getattr(config, "DEFAULT_USER_MAX_CONNECTS_PER_SEC", 0)
+# socket options for client connections, 0 or None keep the kernel defaults
+CLIENT_TCP_NODELAY = getattr(config, "CLIENT_TCP_NODELAY", True)
+CLIENT_SNDBUF = getattr(config, "CLIENT_SNDBUF", 0)
+CLIENT_RCVBUF = getattr(config, "CLIENT_RCVBUF", 0)
+CLIENT_NOTSENT_LOWAT = getattr(config, "CLIENT_NOTSENT_LOWAT", 0)
+# (idle, interval, count) in seconds
+CLIENT_KEEPALIVE = getattr(config, "CLIENT_KEEPALIVE", None)
+# the same for connections to telegram
+TG_TCP_NODELAY = getattr(config, "TG_TCP_NODELAY", True)
+TG_SNDBUF = getattr(config, "TG_SNDBUF", 0)
+TG_RCVBUF = getattr(config, "TG_RCVBUF", 0)
+TG_NOTSENT_LOWAT = getattr(config, "TG_NOTSENT_LOWAT", 0)
+TG_KEEPALIVE = getattr(config, "TG_KEEPALIVE", None)
+# listening socket options
+LISTEN_BACKLOG = getattr(config, "LISTEN_BACKLOG", 1024)
+# the queue length for tcp fast open connections, 0 disables it
+LISTEN_FASTOPEN = getattr(config, "LISTEN_FASTOPEN", 0)
+# wake up the proxy only when the client has sent data, in seconds
+LISTEN_DEFER_ACCEPT = getattr(config, "LISTEN_DEFER_ACCEPT", 0)
+# expect the PROXY protocol v1 or v2 header from load balancers
+PROXY_PROTOCOL = getattr(config, "PROXY_PROTOCOL", False)
+# the header is accepted only from these networks, others are treated as clients
+PROXY_PROTOCOL_TRUSTED = getattr(config, "PROXY_PROTOCOL_TRUSTED", [
+    "127.0.0.0/8", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "::1/128", "fc00::/7"
+])
+# send the dc handshake in one write with the first client data
+PIPELINE_DC_HANDSHAKE = getattr(config, "PIPELINE_DC_HANDSHAKE", True)
+# connect to dcs with tcp fast open, the first data goes in syn, linux only
+TG_FASTOPEN = getattr(config, "TG_FASTOPEN", False)
+# join small middle proxy frames written in one event loop iteration
+WRITE_COALESCING = getattr(config, "WRITE_COALESCING", True)
+# flush the joined frames when they are bigger than this
+COALESCE_MAX_BYTES = getattr(config, "COALESCE_MAX_BYTES", 16384)
+# wait that many seconds for more frames, 0 means till the end of iteration
+COALESCE_DELAY = getattr(config, "COALESCE_DELAY", 0)
+# path of the unix socket for admin commands, None disables it
+ADMIN_SOCKET = getattr(config, "ADMIN_SOCKET", None)
+# http port for the load balancer health checks, None disables it
+HEALTH_PORT = getattr(config, "HEALTH_PORT", None)
+HEALTH_HOST = getattr(config, "HEALTH_HOST", "0.0.0.0")
+# the load is 1 at these numbers, the loop lag limit is OVERLOAD_LOOP_LAG, 0 ignores them
+HEALTH_MAX_CONNECTIONS = getattr(config, "HEALTH_MAX_CONNECTIONS", 0)
+HEALTH_MAX_BUFFER_BYTES = getattr(config, "HEALTH_MAX_BUFFER_BYTES", 100 * 1024 * 1024)
+# the node asks for no new clients from this load, and is overloaded from the second one
+HEALTH_DRAINING_SCORE = getattr(config, "HEALTH_DRAINING_SCORE", 0.8)
+HEALTH_OVERLOADED_SCORE = getattr(config, "HEALTH_OVERLOADED_SCORE", 1.0)
+# sampling profiler settings, it is started by SIGUSR1 or the admin socket
+PROFILE_DURATION = getattr(config, "PROFILE_DURATION", 10)
+# the longest profile the admin socket can ask for, in seconds
+PROFILE_MAX_DURATION = getattr(config, "PROFILE_MAX_DURATION", 300)
+PROFILE_INTERVAL = getattr(config, "PROFILE_INTERVAL", 0.005)
+# where to write the collapsed stacks, suitable for flamegraph.pl
+PROFILE_DIR = getattr(config, "PROFILE_DIR", ".")
+# record chunk sizes and timings of sessions to this file, payloads are never stored
+TRAFFIC_RECORD_FILE = getattr(config, "TRAFFIC_RECORD_FILE", None)
+# the recorder writes to the disk by chunks of this size
+TRAFFIC_RECORD_BUFFER = getattr(config, "TRAFFIC_RECORD_BUFFER", 65536)
+# where to get the middle proxies list and their secret, the getProxyConfig format
+PROXY_CONFIG_URL = getattr(config, "PROXY_CONFIG_URL", "https://core.telegram.org/getProxyConfig")
+PROXY_SECRET_URL = getattr(config, "PROXY_SECRET_URL", "https://core.telegram.org/getProxySecret")
+# how often to refresh them, in seconds
+PROXY_INFO_UPDATE_PERIOD = getattr(config, "PROXY_INFO_UPDATE_PERIOD", 24*60*60)
+# the last fetched ones are kept here, so the start doesn't wait for the network
+PROXY_INFO_CACHE_DIR = getattr(config, "PROXY_INFO_CACHE_DIR", ".")
+# keep binary records of connection events in this memory mapped file, see eventlog.py
+EVENT_LOG_FILE = getattr(config, "EVENT_LOG_FILE", None)
+# the file is a ring of that many records, the oldest ones are overwritten
+EVENT_LOG_RECORDS = getattr(config, "EVENT_LOG_RECORDS", 1000000)
+# keep a stats sample every that many seconds to compute the recent rates
+STATS_HISTORY_PERIOD = getattr(config, "STATS_HISTORY_PERIOD", 10)
+# how many samples to keep, the default is the last 3 hours
+STATS_HISTORY_SAMPLES = getattr(config, "STATS_HISTORY_SAMPLES", 1080)
+# keep the history for every user too, it takes 24 bytes per user per sample,
+# about 26 KB per user with the default samples
+STATS_HISTORY_PER_USER = getattr(config, "STATS_HISTORY_PER_USER", False)
+# the windows, in seconds, to print the rates for
+STATS_HISTORY_WINDOWS = getattr(config, "STATS_HISTORY_WINDOWS", [60, 600, 3600])
+# read TCP_INFO of the client and dc sockets every that many seconds, 0 disables it
+TCP_INFO_PERIOD = getattr(config, "TCP_INFO_PERIOD", 60)
+# the client addresses are grouped by networks of these sizes
+TCP_INFO_PREFIX_V4 = getattr(config, "TCP_INFO_PREFIX_V4", 24)
+TCP_INFO_PREFIX_V6 = getattr(config, "TCP_INFO_PREFIX_V6", 48)
+# how many client networks with the worst rtt to print in the stats
+TCP_INFO_TOP_PREFIXES = getattr(config, "TCP_INFO_TOP_PREFIXES", 5)
+# the lowest level of messages to log: debug, info, warning or error
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "info")
+# log only these subsystems, like {"framing", "sockets"}, None means all of them
+LOG_SUBSYSTEMS = getattr(config, "LOG_SUBSYSTEMS", None)
+# the same message is logged once per that many seconds, the repeats are counted
+LOG_DEDUP_PERIOD = getattr(config, "LOG_DEDUP_PERIOD", 10)
+# max messages per second, the others are dropped
+LOG_RATE_LIMIT = getattr(config, "LOG_RATE_LIMIT", 100)
+# max messages waiting to be written
+LOG_QUEUE_SIZE = getattr(config, "LOG_QUEUE_SIZE", 1000)
+# use uvloop event loop if it is installed
+USE_UVLOOP = getattr(config, "USE_UVLOOP", False)
+# how often to measure the event loop lag, in seconds
+LOOP_LAG_CHECK_PERIOD = getattr(config, "LOOP_LAG_CHECK_PERIOD", 0.5)
+# how many last loop lag measurements to keep for percentiles
+LOOP_LAG_SAMPLES = getattr(config, "LOOP_LAG_SAMPLES", 1200)
 
 TG_DATACENTER_PORT = 443
 
@@ -70,10 +237,12 @@ TG_DATACENTERS_V6 = [
     "2001:67c:04e8:f004::a", "2001:b28:f23f:f005::a"
 ]
 
-TG_MIDDLE_PROXIES_V4 = [
-    ("149.154.175.50", 8888), ("149.154.162.38", 80), ("149.154.175.100", 8888),
-    ("91.108.4.136", 8888), ("91.108.56.181", 8888)
-]
+# dc_idx -> proxies, the proxy is chosen randomly, so repeating it gives it more weight
+TG_MIDDLE_PROXIES_V4 = {
+    0: [("149.154.175.50", 8888)], 1: [("149.154.162.38", 80)],
+    2: [("149.154.175.100", 8888)], 3: [("91.108.4.136", 8888)],
+    4: [("91.108.56.181", 8888)]
+}
 
 
 USE_MIDDLE_PROXY = (len(AD_TAG) == 16)
@@ -102,6 +271,100 @@ MAX_MSG_LEN = 2 ** 24
 
 global_my_ip = None
 
+loop_lags = collections.deque(maxlen=LOOP_LAG_SAMPLES)
+
+rejected_handshakes = collections.Counter()
+
+
+def reject_handshake(reason):
+    rejected_handshakes.update([reason])
+    if event_log:
+        event_log.record(EventLog.REJECTED, reason)
+
+
+# stage -> [count, total seconds]
+stage_timings = collections.defaultdict(lambda: [0, 0.0])
+
+
+# the options which are missing in the socket module of some python versions
+LINUX_SOCK_OPTS = {"TCP_FASTOPEN_CONNECT": 30}
+
+
+def set_sock_opt(sock, level, opt_name, value):
+    opt = getattr(socket, opt_name, None)
+    if opt is None and sys.platform.startswith("linux"):
+        opt = LINUX_SOCK_OPTS.get(opt_name)
+    if opt is None:
+        return False
+    try:
+        sock.setsockopt(level, opt, value)
+        return True
+    except OSError as E:
+        logger.warning("sockets", "Failed to set %s: %s", opt_name, E)
+        return False
+
+
+def setup_socket(sock, nodelay, sndbuf, rcvbuf, notsent_lowat, keepalive):
+    if sock is None:
+        return
+
+    set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_NODELAY", int(nodelay))
+    if sndbuf:
+        set_sock_opt(sock, socket.SOL_SOCKET, "SO_SNDBUF", sndbuf)
+    if rcvbuf:
+        set_sock_opt(sock, socket.SOL_SOCKET, "SO_RCVBUF", rcvbuf)
+    if notsent_lowat:
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_NOTSENT_LOWAT", notsent_lowat)
+    if keepalive:
+        idle, interval, count = keepalive
+        set_sock_opt(sock, socket.SOL_SOCKET, "SO_KEEPALIVE", 1)
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_KEEPIDLE", idle)
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_KEEPINTVL", interval)
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_KEEPCNT", count)
+
+
+def setup_client_socket(sock):
+    # the buffer sizes are inherited from the listening socket
+    setup_socket(sock, CLIENT_TCP_NODELAY, 0, 0, CLIENT_NOTSENT_LOWAT, CLIENT_KEEPALIVE)
+
+
+def setup_tg_socket(sock):
+    setup_socket(sock, TG_TCP_NODELAY, TG_SNDBUF, TG_RCVBUF, TG_NOTSENT_LOWAT, TG_KEEPALIVE)
+
+
+def setup_listen_socket(sock):
+    # the accepted sockets inherit the buffer sizes, which must be set before
+    # the handshake to affect the window scaling
+    if CLIENT_SNDBUF:
+        set_sock_opt(sock, socket.SOL_SOCKET, "SO_SNDBUF", CLIENT_SNDBUF)
+    if CLIENT_RCVBUF:
+        set_sock_opt(sock, socket.SOL_SOCKET, "SO_RCVBUF", CLIENT_RCVBUF)
+    if LISTEN_FASTOPEN:
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_FASTOPEN", LISTEN_FASTOPEN)
+    if LISTEN_DEFER_ACCEPT:
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_DEFER_ACCEPT", LISTEN_DEFER_ACCEPT)
+
+
+async def open_tg_connection(host, port):
+    # the buffer sizes should be set before connect to affect the window scaling
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    setup_tg_socket(sock)
+    if TG_FASTOPEN:
+        # the connect returns at once, the syn is sent with the first write
+        set_sock_opt(sock, socket.IPPROTO_TCP, "TCP_FASTOPEN_CONNECT", 1)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.get_event_loop().sock_connect(sock, (host, port))
+    except OSError:
+        sock.close()
+        raise
+    add_stage_timing("dc_connect", started)
+
+    return await asyncio.open_connection(sock=sock)
+
 
 def init_stats():
     global stats
@@ -118,7 +381,450 @@ def update_stats(user, connects=0, curr_connects_x2=0, octets=0):
                        octets=octets)
 
 
+def add_stage_timing(stage, started):
+    timing = stage_timings[stage]
+    timing[0] += 1
+    timing[1] += time.perf_counter() - started
+
+
+def get_percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, len(sorted_values) * percent // 100)
+    return sorted_values[idx]
+
+
+def get_loop_lag():
+    if not loop_lags:
+        return 0
+    return loop_lags[-1]
+
+
+def get_loop_lag_percentiles(percents=(50, 90, 99, 100)):
+    lags = sorted(loop_lags)
+    return [get_percentile(lags, percent) for percent in percents]
+
+
+# the samples are kept in preallocated ring arrays, one array per series
+class StatsHistory:
+    COUNTERS = ("connects", "octets", "rejected")
+
+    def __init__(self, period, samples, per_user):
+        self.period = period
+        self.samples = samples
+        self.per_user = per_user
+        self.times = array.array("d", bytes(8 * samples))
+        # (user or None for the totals, metric) -> values
+        self.series = {}
+        self.pos = 0
+        self.count = 0
+
+    def get_series(self, key):
+        if key not in self.series:
+            self.series[key] = array.array("d", bytes(8 * self.samples))
+        return self.series[key]
+
+    def add_sample(self):
+        idx = self.pos
+        self.times[idx] = time.time()
+
+        totals = {
+            "connects": sum(stat["connects"] for stat in stats.values()),
+            "octets": sum(stat["octets"] for stat in stats.values()),
+            "connections": sum(stat["curr_connects_x2"] for stat in stats.values()) // 2,
+            "rejected": sum(rejected_handshakes.values())
+        }
+        if self.per_user:
+            for user, stat in stats.items():
+                self.get_series((user, "connects"))[idx] = stat["connects"]
+                self.get_series((user, "octets"))[idx] = stat["octets"]
+                self.get_series((user, "connections"))[idx] = stat["curr_connects_x2"] // 2
+
+        for metric, value in totals.items():
+            self.get_series((None, metric))[idx] = value
+
+        self.pos = (idx + 1) % self.samples
+        self.count = min(self.count + 1, self.samples)
+
+    def get_points(self, key, window):
+        if key not in self.series or not self.count:
+            return []
+        values = self.series[key]
+        newest_time = self.times[(self.pos - 1) % self.samples]
+
+        # the samples are at least a period apart, so older ones are out of the window
+        count = min(self.count, int(window // self.period) + 1)
+
+        points = []
+        for i in range(count):
+            idx = (self.pos - count + i) % self.samples
+            if self.times[idx] >= newest_time - window:
+                points.append((self.times[idx], values[idx]))
+        return points
+
+    def get_rate(self, key, window):
+        points = self.get_points(key, window)
+        if len(points) < 2:
+            return {"avg": 0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+
+        rates = sorted((v2 - v1) / max(t2 - t1, 1e-6)
+                       for (t1, v1), (t2, v2) in zip(points, points[1:]))
+        (first_time, first_value), (last_time, last_value) = points[0], points[-1]
+        ret = {"avg": (last_value - first_value) / max(last_time - first_time, 1e-6)}
+        for percent in (50, 90, 99):
+            ret["p%d" % percent] = get_percentile(rates, percent)
+        ret["max"] = rates[-1]
+        return ret
+
+    def get_gauge(self, key, window):
+        values = sorted(value for timestamp, value in self.get_points(key, window))
+        if not values:
+            return {"last": 0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+
+        ret = {"last": self.series[key][(self.pos - 1) % self.samples]}
+        for percent in (50, 90, 99):
+            ret["p%d" % percent] = get_percentile(values, percent)
+        ret["max"] = values[-1]
+        return ret
+
+    def query(self, user=None, window=600, with_points=False):
+        ret = {
+            "window": window,
+            "connects_per_sec": self.get_rate((user, "connects"), window),
+            "octets_per_sec": self.get_rate((user, "octets"), window),
+            "connections": self.get_gauge((user, "connections"), window)
+        }
+        if user is None:
+            ret["rejected_per_sec"] = self.get_rate((None, "rejected"), window)
+        if with_points:
+            ret["points"] = {metric: self.get_points((user, metric), window)
+                             for metric in self.COUNTERS + ("connections",)
+                             if (user, metric) in self.series}
+        return ret
+
+
+stats_history = StatsHistory(STATS_HISTORY_PERIOD, STATS_HISTORY_SAMPLES, STATS_HISTORY_PER_USER)
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+# xor of decryptor and encryptor ctr keystreams, applying it to the data
+# is the same as decrypting and encrypting it again
+class CombinedKeystream:
+    __slots__ = ("decryptor", "encryptor", "buf")
+
+    def __init__(self, decryptor, encryptor):
+        self.decryptor = decryptor
+        self.encryptor = encryptor
+        self.buf = bytearray()
+
+    def generate(self, n):
+        zeros = bytes(n)
+        self.buf += xor_bytes(self.decryptor.decrypt(zeros), self.encryptor.encrypt(zeros))
+
+    def prefetch(self, size):
+        if len(self.buf) < size:
+            self.generate(size - len(self.buf))
+
+    def transcode(self, data):
+        if len(data) > len(self.buf):
+            self.generate(len(data) - len(self.buf))
+
+        ret = xor_bytes(data, self.buf[:len(data)])
+        del self.buf[:len(data)]
+        return ret
+
+
+if CRYPTO_OFFLOAD:
+    crypto_executor = concurrent.futures.ThreadPoolExecutor(CRYPTO_OFFLOAD_WORKERS)
+else:
+    crypto_executor = None
+
+
+def should_offload_crypto(crypto, data):
+    if crypto is fake_encryptor or crypto is fake_decryptor:
+        return False
+    return crypto_executor is not None and len(data) >= CRYPTO_OFFLOAD_THRESHOLD
+
+
+async def offload_crypto(func, data):
+    return await asyncio.get_event_loop().run_in_executor(crypto_executor, func, data)
+
+
+class TranscodingStreamReader:
+    __slots__ = ("stream", "keystream", "prefetch_size", "prefetch_scheduled", "prefetching",
+                 "offloaded")
+
+    def __init__(self, stream, keystream, prefetch_size=0):
+        self.stream = stream
+        self.keystream = keystream
+        self.prefetch_size = prefetch_size
+        self.prefetch_scheduled = False
+        # the prefetch running in a worker thread
+        self.prefetching = None
+        self.offloaded = False
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def prefetch(self):
+        self.prefetch_scheduled = False
+        # the keystream is busy in a worker thread
+        if self.offloaded or self.prefetching:
+            return
+        self.keystream.prefetch(self.prefetch_size)
+
+    def schedule_prefetch(self):
+        if not self.prefetch_size or self.prefetch_scheduled or self.prefetching:
+            return
+        if len(self.keystream.buf) >= self.prefetch_size // 2:
+            return
+
+        if crypto_executor is not None:
+            # the worker thread doesn't block the loop, so start it at once
+            self.prefetching = asyncio.get_event_loop().run_in_executor(
+                crypto_executor, self.keystream.prefetch, self.prefetch_size)
+        else:
+            # runs only after the reader yields, so bursts are not delayed
+            self.prefetch_scheduled = True
+            asyncio.get_event_loop().call_soon(self.prefetch)
+
+    async def transcode(self, data):
+        if self.prefetching:
+            try:
+                await self.prefetching
+            finally:
+                self.prefetching = None
+
+        if should_offload_crypto(self.keystream, data):
+            self.offloaded = True
+            try:
+                return await offload_crypto(self.keystream.transcode, data)
+            finally:
+                self.offloaded = False
+
+        return self.keystream.transcode(data)
+
+    async def read(self, n):
+        data = await self.stream.read(n)
+        if not data:
+            return data
+        ret = await self.transcode(data)
+        self.schedule_prefetch()
+        return ret
+
+    async def readexactly(self, n):
+        data = await self.stream.readexactly(n)
+        ret = await self.transcode(data)
+        self.schedule_prefetch()
+        return ret
+
+
+def fuse_reencryption(reader, writer):
+    keystream = CombinedKeystream(reader.decryptor, writer.encryptor)
+    reader = TranscodingStreamReader(reader.stream, keystream, KEYSTREAM_PREFETCH_SIZE)
+    return reader, writer.stream
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_consume(self, n):
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def consume(self, n):
+        # tokens can go below zero, the caller should wait the returned time
+        self.refill()
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+# the messages are formatted and written by a separate thread, so a flood of
+# them never blocks the event loop
+class Logger:
+    LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+    def __init__(self):
+        self.min_level = self.LEVELS.get(LOG_LEVEL, 20)
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.bucket = TokenBucket(LOG_RATE_LIMIT)
+        # (subsystem, msg format) -> [last logged time, repeats since]
+        self.recent = {}
+        self.dropped = 0
+        self.thread = None
+
+    def log(self, level, subsystem, msg, *args):
+        if self.LEVELS[level] < self.min_level:
+            return
+        if LOG_SUBSYSTEMS is not None and subsystem not in LOG_SUBSYSTEMS:
+            return
+
+        now = time.monotonic()
+        recent = self.recent.get((subsystem, msg))
+        if recent and now - recent[0] < LOG_DEDUP_PERIOD:
+            recent[1] += 1
+            return
+        repeats = recent[1] if recent else 0
+        # the formats are expected to be constant, but never grow without a limit
+        if len(self.recent) > 10000:
+            self.recent.clear()
+        self.recent[(subsystem, msg)] = [now, 0]
+
+        if not self.bucket.try_consume(1):
+            self.dropped += 1
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), level, subsystem, msg, args, repeats,
+                                   self.dropped))
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+            return
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def debug(self, subsystem, msg, *args):
+        self.log("debug", subsystem, msg, *args)
+
+    def info(self, subsystem, msg, *args):
+        self.log("info", subsystem, msg, *args)
+
+    def warning(self, subsystem, msg, *args):
+        self.log("warning", subsystem, msg, *args)
+
+    def error(self, subsystem, msg, *args):
+        self.log("error", subsystem, msg, *args)
+
+    def format(self, record):
+        timestamp, level, subsystem, msg, args, repeats, dropped = record
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = " ".join([msg] + [str(arg) for arg in args])
+        line = "%s %s %s: %s" % (time.strftime("%d.%m.%Y %H:%M:%S", time.localtime(timestamp)),
+                                 level.upper(), subsystem, msg)
+        if repeats:
+            line += " (%d repeats suppressed)" % repeats
+        if dropped:
+            line += " (%d messages dropped before)" % dropped
+        return line
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            print(self.format(record), flush=self.queue.empty())
+            self.queue.task_done()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+logger = Logger()
+
+
+# deficit round robin over the per user queues
+class FairEgressScheduler:
+    def __init__(self, rate, quantum):
+        self.bucket = TokenBucket(rate)
+        self.quantum = quantum
+        self.queues = collections.OrderedDict()
+        self.deficits = collections.Counter()
+        self.wakeup = None
+        self.task = None
+
+    async def wait_turn(self, user, size):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+        fut = asyncio.get_event_loop().create_future()
+        self.queues.setdefault(user, collections.deque()).append((size, fut))
+        if self.wakeup and not self.wakeup.done():
+            self.wakeup.set_result(None)
+        await fut
+
+    async def run(self):
+        while True:
+            if not self.queues:
+                self.wakeup = asyncio.get_event_loop().create_future()
+                await self.wakeup
+                continue
+
+            for user in list(self.queues):
+                queue = self.queues[user]
+                self.deficits[user] += self.quantum
+                while queue and queue[0][0] <= self.deficits[user]:
+                    size, fut = queue.popleft()
+                    self.deficits[user] -= size
+                    delay = self.bucket.consume(size)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if not fut.done():
+                        fut.set_result(None)
+
+                if not queue:
+                    del self.queues[user]
+                    del self.deficits[user]
+
+
+user_buckets = {}
+egress_scheduler = None
+if EGRESS_BANDWIDTH:
+    egress_scheduler = FairEgressScheduler(EGRESS_BANDWIDTH, EGRESS_QUANTUM)
+
+
+def get_user_bucket(user):
+    if user not in user_buckets:
+        limit = USER_BANDWIDTH_LIMITS.get(user, DEFAULT_USER_BANDWIDTH_LIMIT)
+        user_buckets[user] = TokenBucket(limit) if limit else None
+    return user_buckets[user]
+
+
+async def shape_traffic(user, size, conn_bucket=None):
+    delay = 0
+    if conn_bucket:
+        delay = conn_bucket.consume(size)
+
+    user_bucket = get_user_bucket(user)
+    if user_bucket:
+        delay = max(delay, user_bucket.consume(size))
+
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    if egress_scheduler:
+        await egress_scheduler.wait_turn(user, size)
+
+
 class CryptoWrappedStreamReader:
+    __slots__ = ("stream", "decryptor", "block_size", "buf")
+
     def __init__(self, stream, decryptor, block_size=1):
         self.stream = stream
         self.decryptor = decryptor
@@ -128,9 +834,14 @@ class CryptoWrappedStreamReader:
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
 
+    async def decrypt(self, data):
+        if should_offload_crypto(self.decryptor, data):
+            return await offload_crypto(self.decryptor.decrypt, data)
+        return self.decryptor.decrypt(data)
+
     async def read(self, n):
         if self.buf:
-            ret = self.buf
+            ret = bytes(self.buf)
             self.buf.clear()
             return ret
         else:
@@ -138,8 +849,8 @@ class CryptoWrappedStreamReader:
 
             needed_till_full_block = -len(readed) % self.block_size
             if needed_till_full_block > 0:
-                readed += self.stream.readexactly(needed_till_full_block)
-            return self.decryptor.decrypt(readed)
+                readed += await self.stream.readexactly(needed_till_full_block)
+            return await self.decrypt(readed)
 
     async def readexactly(self, n):
         if n > len(self.buf):
@@ -148,7 +859,7 @@ class CryptoWrappedStreamReader:
 
             to_read_block_aligned = to_read + needed_till_full_block
             data = await self.stream.readexactly(to_read_block_aligned)
-            self.buf += self.decryptor.decrypt(data)
+            self.buf += await self.decrypt(data)
 
         ret = bytes(self.buf[:n])
         self.buf = self.buf[n:]
@@ -156,24 +867,137 @@ class CryptoWrappedStreamReader:
 
 
 class CryptoWrappedStreamWriter:
+    __slots__ = ("stream", "encryptor", "block_size", "offloaded_writes")
+
     def __init__(self, stream, encryptor, block_size=1):
         self.stream = stream
         self.encryptor = encryptor
         self.block_size = block_size
+        self.offloaded_writes = None
 
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
 
+    async def encrypt_and_write(self, data, prev_writes):
+        # the encryptor is stateful, so the writes are chained to keep the order
+        if prev_writes:
+            await prev_writes
+
+        if should_offload_crypto(self.encryptor, data):
+            q = await offload_crypto(self.encryptor.encrypt, data)
+        else:
+            q = self.encryptor.encrypt(data)
+        self.stream.write(q)
+
     def write(self, data):
         if len(data) % self.block_size != 0:
-            print("BUG: writing %d bytes not aligned to block size %d" % (
-                len(data), self.block_size))
+            logger.error("crypto", "BUG: writing %d bytes not aligned to block size %d",
+                         len(data), self.block_size)
             return 0
+
+        has_offloaded_writes = self.offloaded_writes and not self.offloaded_writes.done()
+        if has_offloaded_writes or should_offload_crypto(self.encryptor, data):
+            prev_writes = self.offloaded_writes if has_offloaded_writes else None
+            self.offloaded_writes = asyncio.ensure_future(
+                self.encrypt_and_write(data, prev_writes))
+            return len(data)
+
         q = self.encryptor.encrypt(data)
         return self.stream.write(q)
 
+    async def call_after_writes(self, func, prev_writes):
+        try:
+            await prev_writes
+        except Exception:
+            pass
+        func()
+
+    def after_writes(self, func):
+        # the eof and the close must not overtake the offloaded writes
+        if self.offloaded_writes and not self.offloaded_writes.done():
+            self.offloaded_writes = asyncio.ensure_future(
+                self.call_after_writes(func, self.offloaded_writes))
+        else:
+            func()
+
+    def write_eof(self):
+        self.after_writes(self.stream.write_eof)
+
+    def close(self):
+        self.after_writes(self.stream.close)
+
+    async def drain(self):
+        if self.offloaded_writes:
+            await self.offloaded_writes
+        await self.stream.drain()
+
+
+class CoalescingStreamWriter:
+    __slots__ = ("stream", "max_bytes", "delay", "buf", "flush_handle")
+
+    def __init__(self, stream, max_bytes=COALESCE_MAX_BYTES, delay=COALESCE_DELAY):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.delay = delay
+        self.buf = bytearray()
+        self.flush_handle = None
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.buf:
+            data = bytes(self.buf)
+            self.buf.clear()
+            self.stream.write(data)
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= self.max_bytes:
+            self.flush()
+        elif not self.flush_handle:
+            loop = asyncio.get_event_loop()
+            if self.delay:
+                self.flush_handle = loop.call_later(self.delay, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+        return len(data)
+
+    def write_eof(self):
+        self.flush()
+        return self.stream.write_eof()
+
+    def close(self):
+        self.flush()
+        return self.stream.close()
+
+
+# holds the dc handshake till the first data, so they go in one write and in syn
+# with TG_FASTOPEN, the client almost always sends its first data with the handshake
+class DeferredHandshakeStreamWriter:
+    __slots__ = ("stream", "handshake")
+
+    def __init__(self, stream, handshake):
+        self.stream = stream
+        self.handshake = handshake
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def write(self, data):
+        if self.handshake:
+            data = self.handshake + data
+            self.handshake = None
+        return self.stream.write(data)
+
 
 class MTProtoFrameStreamReader:
+    __slots__ = ("stream", "seq_no")
+
     def __init__(self, stream, seq_no=0):
         self.stream = stream
         self.seq_no = seq_no
@@ -191,14 +1015,14 @@ class MTProtoFrameStreamReader:
 
         len_is_impossible = (msg_len % len(PADDING_FILLER) != 0)
         if not MIN_MSG_LEN <= msg_len <= MAX_MSG_LEN or len_is_impossible:
-            print("msg_len is bad, closing connection", msg_len)
+            logger.warning("framing", "msg_len is bad, closing connection: %d", msg_len)
             self.stream.feed_eof()
             return b""
 
         msg_seq_bytes = await self.stream.readexactly(4)
         msg_seq = int.from_bytes(msg_seq_bytes, "little", signed=True)
         if msg_seq != self.seq_no:
-            print("unexpected seq_no")
+            logger.warning("framing", "unexpected seq_no")
             self.stream.feed_eof()
             return b""
 
@@ -216,6 +1040,8 @@ class MTProtoFrameStreamReader:
 
 
 class MTProtoCompactFrameStreamReader:
+    __slots__ = ("stream",)
+
     def __init__(self, stream):
         self.stream = stream
 
@@ -241,6 +1067,8 @@ class MTProtoCompactFrameStreamReader:
 
 
 class MTProtoCompactFrameStreamWriter:
+    __slots__ = ("stream", "seq_no")
+
     def __init__(self, stream, seq_no=0):
         self.stream = stream
         self.seq_no = seq_no
@@ -253,7 +1081,9 @@ class MTProtoCompactFrameStreamWriter:
         LARGE_PKT_BORGER = 256 ** 3
 
         if len(data) % 4 != 0:
-            print("BUG: MTProtoFrameStreamWriter attempted to send msg with len %d" % len(msg))
+            logger.error("framing",
+                         "BUG: MTProtoFrameStreamWriter attempted to send msg with len %d",
+                         len(data))
             return 0
 
         len_div_four = len(data) // 4
@@ -264,11 +1094,13 @@ class MTProtoCompactFrameStreamWriter:
             return self.stream.write(b'\x7f' + bytes(int.to_bytes(len_div_four, 3, 'little')) +
                                      data)
         else:
-            print("Attempted to send too large pkt len =", len(data))
+            logger.warning("framing", "Attempted to send too large pkt len = %d", len(data))
             return 0
 
 
 class MTProtoFrameStreamWriter:
+    __slots__ = ("stream", "seq_no")
+
     def __init__(self, stream, seq_no=0):
         self.stream = stream
         self.seq_no = seq_no
@@ -291,6 +1123,8 @@ class MTProtoFrameStreamWriter:
 
 
 class ProxyReqStreamReader:
+    __slots__ = ("stream",)
+
     def __init__(self, stream):
         self.stream = stream
 
@@ -312,15 +1146,19 @@ class ProxyReqStreamReader:
             return b""
 
         if ans_type != RPC_PROXY_ANS:
-            print("ans_type != RPC_PROXY_ANS", ans_type)
+            logger.warning("middleproxy", "ans_type != RPC_PROXY_ANS: %r", ans_type)
             return b""
 
         return conn_data
 
 
 class ProxyReqStreamWriter:
-    def __init__(self, stream):
+    __slots__ = ("stream", "remote_ip_port", "our_ip_port")
+
+    def __init__(self, stream, remote_ip_port=b"A" * 20, our_ip_port=b"B" * 20):
         self.stream = stream
+        self.remote_ip_port = remote_ip_port
+        self.our_ip_port = our_ip_port
 
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
@@ -329,28 +1167,312 @@ class ProxyReqStreamWriter:
         RPC_PROXY_REQ = b"\xee\xf1\xce\x36"
         FLAGS = b"\x08\x10\x02\x40"
         OUT_CONN_ID = bytearray([random.randrange(0, 256) for i in range(8)])
-        REMOTE_IP_PORT = b"A" * 20
-        OUR_IP_PORT = b"B" * 20
         EXTRA_SIZE = b"\x18\x00\x00\x00"
         PROXY_TAG = b"\xae\x26\x1e\xdb"
         FOUR_BYTES_ALIGNER = b"\x00\x00\x00"
 
         if len(msg) % 4 != 0:
-            print("BUG: attempted to send msg with len %d" % len(msg))
+            logger.error("middleproxy", "BUG: attempted to send msg with len %d", len(msg))
             return 0
 
         full_msg = bytearray()
-        full_msg += RPC_PROXY_REQ + FLAGS + OUT_CONN_ID + REMOTE_IP_PORT
-        full_msg += OUR_IP_PORT + EXTRA_SIZE + PROXY_TAG
+        full_msg += RPC_PROXY_REQ + FLAGS + OUT_CONN_ID + self.remote_ip_port
+        full_msg += self.our_ip_port + EXTRA_SIZE + PROXY_TAG
         full_msg += bytes([len(AD_TAG)]) + AD_TAG + FOUR_BYTES_ALIGNER
         full_msg += msg
 
         return self.stream.write(full_msg)
 
 
+class RotatingBloomFilter:
+    HASHES_NUM = 4
+
+    def __init__(self, bits, window):
+        self.bits = bits
+        self.window = window
+        self.curr = bytearray(bits // 8)
+        self.prev = bytearray(bits // 8)
+        self.rotated_at = time.monotonic()
+
+    def rotate_if_needed(self):
+        # every element stays in the filter at least for the window
+        now = time.monotonic()
+        if now - self.rotated_at >= self.window / 2:
+            self.prev, self.curr = self.curr, self.prev
+            self.curr[:] = bytes(len(self.curr))
+            self.rotated_at = now
+
+    def get_positions(self, data):
+        h1, h2 = hash(data), hash(data[::-1]) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.HASHES_NUM)]
+
+    def check_and_add(self, data):
+        self.rotate_if_needed()
+
+        found_curr = found_prev = True
+        for pos in self.get_positions(data):
+            byte_pos, bit = pos >> 3, 1 << (pos & 7)
+            if not self.curr[byte_pos] & bit:
+                found_curr = False
+                self.curr[byte_pos] |= bit
+            if not self.prev[byte_pos] & bit:
+                found_prev = False
+        return found_curr or found_prev
+
+
+def get_ban_key(ip):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+
+    if addr.version == 6:
+        if addr.ipv4_mapped:
+            return str(addr.ipv4_mapped)
+        # one client usually gets the whole /64
+        return str(ipaddress.ip_network((addr, 64), strict=False))
+    return ip
+
+
+class FailedHandshakesTracker:
+    def __init__(self, fails_before_ban, min_ban_time, max_ban_time, max_ips):
+        self.fails_before_ban = fails_before_ban
+        self.min_ban_time = min_ban_time
+        self.max_ban_time = max_ban_time
+        self.max_ips = max_ips
+        # ip -> [fails in a row, banned until], the least recently failed first
+        self.ips = collections.OrderedDict()
+        self.cleaned_at = time.monotonic()
+
+    def is_banned(self, ip):
+        if not self.fails_before_ban:
+            return False
+        ip_info = self.ips.get(get_ban_key(ip))
+        return ip_info is not None and ip_info[1] > time.monotonic()
+
+    def on_success(self, ip):
+        self.ips.pop(get_ban_key(ip), None)
+
+    def on_failure(self, ip):
+        if not self.fails_before_ban:
+            return
+
+        now = time.monotonic()
+        self.cleanup(now)
+
+        key = get_ban_key(ip)
+        ip_info = self.ips.setdefault(key, [0, 0])
+        self.ips.move_to_end(key)
+        while len(self.ips) > self.max_ips:
+            self.ips.popitem(last=False)
+
+        ip_info[0] += 1
+        extra_fails = ip_info[0] - self.fails_before_ban
+        if extra_fails >= 0:
+            ban_time = min(self.min_ban_time * 2 ** min(extra_fails, 32), self.max_ban_time)
+            ip_info[1] = now + ban_time
+
+    def cleanup(self, now):
+        if now - self.cleaned_at < self.max_ban_time:
+            return
+        self.cleaned_at = now
+
+        # the ban is over and there were no fails since then
+        self.ips = collections.OrderedDict(
+            (ip, info) for ip, info in self.ips.items() if info[1] + self.max_ban_time > now)
+
+
+replay_filter = None
+if REPLAY_CHECK:
+    replay_filter = RotatingBloomFilter(REPLAY_CHECK_BITS, REPLAY_CHECK_WINDOW)
+failed_handshakes = FailedHandshakesTracker(BAN_AFTER_FAILED_HANDSHAKES, BAN_MIN_TIME,
+                                            BAN_MAX_TIME, BAN_MAX_TRACKED_IPS)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit, queue_size, queue_timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiters = collections.deque()
+
+    def get_limit(self):
+        if not self.limit:
+            return float("inf")
+
+        lag = get_loop_lag()
+        if OVERLOAD_LOOP_LAG and lag > OVERLOAD_LOOP_LAG:
+            return max(1, int(self.limit * OVERLOAD_LOOP_LAG / lag))
+        return self.limit
+
+    async def acquire(self):
+        if self.in_flight < self.get_limit() and not self.waiters:
+            self.in_flight += 1
+            return True
+
+        if len(self.waiters) >= self.queue_size:
+            return False
+
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            # the slot can be passed in the same loop iteration as the timeout fires
+            return fut.done() and not fut.cancelled()
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            if fut in self.waiters:
+                self.waiters.remove(fut)
+
+    def release(self):
+        self.in_flight -= 1
+
+        # the slot is passed to the waiter directly
+        while self.waiters and self.in_flight < self.get_limit():
+            fut = self.waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(True)
+
+
+handshakes_limiter = ConcurrencyLimiter(MAX_HANDSHAKES_IN_FLIGHT, ACCEPT_QUEUE_SIZE,
+                                        ACCEPT_QUEUE_TIMEOUT)
+upstream_connects_limiter = ConcurrencyLimiter(MAX_UPSTREAM_CONNECTS, ACCEPT_QUEUE_SIZE,
+                                               ACCEPT_QUEUE_TIMEOUT)
+
+
+user_connect_buckets = {}
+
+
+def acquire_user_connection(user):
+    max_connections = USER_MAX_CONNECTIONS.get(user, DEFAULT_USER_MAX_CONNECTIONS)
+    if max_connections and user in stats:
+        if stats[user]["curr_connects_x2"] // 2 >= max_connections:
+            return False
+
+    if user not in user_connect_buckets:
+        rate = USER_MAX_CONNECTS_PER_SEC.get(user, DEFAULT_USER_MAX_CONNECTS_PER_SEC)
+        user_connect_buckets[user] = TokenBucket(rate, burst=max(rate, 1)) if rate else None
+
+    bucket = user_connect_buckets[user]
+    if bucket and not bucket.try_consume(1):
+        return False
+
+    # both relay halves give the connection back when they finish
+    update_stats(user, curr_connects_x2=2)
+    return True
+
+
+def get_peer_addr(writer):
+    peername = writer.get_extra_info("peername")
+    return peername[:2] if peername else None
+
+
+def get_peer_ip(writer):
+    peer_addr = get_peer_addr(writer)
+    return peer_addr[0] if peer_addr else None
+
+
+def encode_ip_port(ip, port):
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 4:
+        ip_bytes = b"\x00" * 10 + b"\xff\xff" + addr.packed
+    else:
+        ip_bytes = addr.packed
+    return ip_bytes + int.to_bytes(port, 4, "little")
+
+
+# the client address given by a load balancer in the PROXY protocol header
+class PeerAddressStreamWriter:
+    __slots__ = ("stream", "peername")
+
+    def __init__(self, stream, peername):
+        self.stream = stream
+        self.peername = peername
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.peername
+        return self.stream.get_extra_info(name, default)
+
+
+PROXY_PROTOCOL_V2_SIGNATURE = b"\r\n\r\n\x00\r\nQUIT\n"
+PROXY_PROTOCOL_V1_MAX_LEN = 107
+
+proxy_protocol_trusted_networks = [ipaddress.ip_network(net) for net in PROXY_PROTOCOL_TRUSTED]
+
+
+def is_trusted_proxy(ip):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+
+    if addr.version == 6 and addr.ipv4_mapped:
+        addr = addr.ipv4_mapped
+    return any(addr in net for net in proxy_protocol_trusted_networks)
+
+
+# returns the client address, None if the balancer doesn't know it, like in its health checks
+async def read_proxy_protocol_header(reader):
+    header = await reader.readexactly(len(PROXY_PROTOCOL_V2_SIGNATURE))
+
+    if header == PROXY_PROTOCOL_V2_SIGNATURE:
+        ver_cmd, family, length = struct.unpack(">BBH", await reader.readexactly(4))
+        addrs = await reader.readexactly(length)
+        if ver_cmd >> 4 != 2:
+            raise ValueError("bad proxy protocol version")
+        if ver_cmd & 0xF == 0:
+            return None
+
+        if family >> 4 == 1 and length >= 12:
+            return socket.inet_ntop(socket.AF_INET, addrs[:4]), int.from_bytes(addrs[8:10], "big")
+        if family >> 4 == 2 and length >= 36:
+            return (socket.inet_ntop(socket.AF_INET6, addrs[:16]),
+                    int.from_bytes(addrs[32:34], "big"))
+        return None
+
+    if header.startswith(b"PROXY "):
+        try:
+            line = header + await reader.readuntil(b"\r\n")
+        except asyncio.LimitOverrunError:
+            raise ValueError("too long proxy protocol header")
+        if len(line) > PROXY_PROTOCOL_V1_MAX_LEN:
+            raise ValueError("too long proxy protocol header")
+
+        parts = line[:-2].decode("ascii").split(" ")
+        if parts[1] == "UNKNOWN":
+            return None
+        if len(parts) != 6 or parts[1] not in ("TCP4", "TCP6"):
+            raise ValueError("bad proxy protocol header")
+        return str(ipaddress.ip_address(parts[2])), int(parts[4])
+
+    raise ValueError("no proxy protocol header")
+
+
 async def handle_handshake(reader, writer):
+    peer_ip = get_peer_ip(writer)
+    if failed_handshakes.is_banned(peer_ip):
+        reject_handshake("banned")
+        return False
+
     handshake = await reader.readexactly(HANDSHAKE_LEN)
 
+    prekey_and_iv = handshake[SKIP_LEN:SKIP_LEN+PREKEY_LEN+IV_LEN]
+    if replay_filter and replay_filter.check_and_add(prekey_and_iv):
+        reject_handshake("replayed")
+        failed_handshakes.on_failure(peer_ip)
+        return False
+
     for user in USERS:
         secret = bytes.fromhex(USERS[user])
 
@@ -374,9 +1496,18 @@ async def handle_handshake(reader, writer):
         if dc_idx == 0:
             continue
 
+        failed_handshakes.on_success(peer_ip)
+
+        if not acquire_user_connection(user):
+            reject_handshake("user_limit")
+            return False
+
         reader = CryptoWrappedStreamReader(reader, decryptor)
         writer = CryptoWrappedStreamWriter(writer, encryptor)
         return reader, writer, user, dc_idx, enc_key + enc_iv
+
+    reject_handshake("bad")
+    failed_handshakes.on_failure(peer_ip)
     return False
 
 
@@ -396,7 +1527,7 @@ async def do_direct_handshake(dc_idx, dec_key_and_iv=None):
         dc = TG_DATACENTERS_V4[dc_idx]
 
     try:
-        reader_tgt, writer_tgt = await asyncio.open_connection(dc, TG_DATACENTER_PORT)
+        reader_tgt, writer_tgt = await open_tg_connection(dc, TG_DATACENTER_PORT)
     except ConnectionRefusedError as E:
         return False
     except OSError as E:
@@ -429,8 +1560,11 @@ async def do_direct_handshake(dc_idx, dec_key_and_iv=None):
 
     rnd_enc = rnd[:MAGIC_VAL_POS] + encryptor.encrypt(rnd)[MAGIC_VAL_POS:]
 
-    writer_tgt.write(rnd_enc)
-    await writer_tgt.drain()
+    if PIPELINE_DC_HANDSHAKE:
+        writer_tgt = DeferredHandshakeStreamWriter(writer_tgt, rnd_enc)
+    else:
+        writer_tgt.write(rnd_enc)
+        await writer_tgt.drain()
 
     reader_tgt = CryptoWrappedStreamReader(reader_tgt, decryptor)
     writer_tgt = CryptoWrappedStreamWriter(writer_tgt, encryptor)
@@ -459,7 +1593,7 @@ def get_middleproxy_aes_key_and_iv(nonce_srv, nonce_clt, clt_ts, srv_ip, clt_por
     return key, iv
 
 
-async def do_middleproxy_handshake(dc_idx):
+async def do_middleproxy_handshake(dc_idx, clt_addr=None):
     START_SEQ_NO = -2
     NONCE_LEN = 16
 
@@ -475,12 +1609,15 @@ async def do_middleproxy_handshake(dc_idx):
     SENDER_PID = b"IPIPPRPDTIME"
     PEER_PID = b"IPIPPRPDTIME"
 
-    if not 0 <= dc_idx < len(TG_MIDDLE_PROXIES_V4):
+    if dc_idx not in TG_MIDDLE_PROXIES_V4:
         return False
-    addr, port = TG_MIDDLE_PROXIES_V4[dc_idx]
+    addr, port = random.choice(TG_MIDDLE_PROXIES_V4[dc_idx])
+
+    # the secret can be updated while we are waiting for the proxy
+    proxy_secret = PROXY_SECRET
 
     try:
-        reader_tgt, writer_tgt = await asyncio.open_connection(addr, port)
+        reader_tgt, writer_tgt = await open_tg_connection(addr, port)
     except ConnectionRefusedError as E:
         return False
     except OSError as E:
@@ -488,7 +1625,7 @@ async def do_middleproxy_handshake(dc_idx):
 
     writer_tgt = MTProtoFrameStreamWriter(writer_tgt, START_SEQ_NO)
 
-    key_selector = PROXY_SECRET[:4]
+    key_selector = proxy_secret[:4]
     crypto_ts = int.to_bytes(int(time.time()) % (256**4), 4, "little")
 
     nonce = bytes([random.randrange(0, 256) for i in range(NONCE_LEN)])
@@ -526,12 +1663,12 @@ async def do_middleproxy_handshake(dc_idx):
     enc_key, enc_iv = get_middleproxy_aes_key_and_iv(
         nonce_srv=rpc_nonce, nonce_clt=nonce, clt_ts=crypto_ts, srv_ip=tg_ip_bytes,
         clt_port=my_port_bytes, purpose=b"CLIENT", clt_ip=my_ip_bytes,
-        srv_port=tg_port_bytes, middleproxy_secret=PROXY_SECRET, clt_ipv6=None, srv_ipv6=None)
+        srv_port=tg_port_bytes, middleproxy_secret=proxy_secret, clt_ipv6=None, srv_ipv6=None)
 
     dec_key, dec_iv = get_middleproxy_aes_key_and_iv(
         nonce_srv=rpc_nonce, nonce_clt=nonce, clt_ts=crypto_ts, srv_ip=tg_ip_bytes,
         clt_port=my_port_bytes, purpose=b"SERVER", clt_ip=my_ip_bytes,
-        srv_port=tg_port_bytes, middleproxy_secret=PROXY_SECRET, clt_ipv6=None, srv_ipv6=None)
+        srv_port=tg_port_bytes, middleproxy_secret=proxy_secret, clt_ipv6=None, srv_ipv6=None)
 
     encryptor = create_aes_cbc(key=enc_key, iv=enc_iv)
     decryptor = create_aes_cbc(key=dec_key, iv=dec_iv)
@@ -554,14 +1691,242 @@ async def do_middleproxy_handshake(dc_idx):
     if handshake_type != RPC_HANDSHAKE or handshake_peer_pid != SENDER_PID:
         return False
 
-    writer_tgt = ProxyReqStreamWriter(writer_tgt)
+    if WRITE_COALESCING:
+        writer_tgt.stream = CoalescingStreamWriter(writer_tgt.stream)
+
+    if clt_addr and global_my_ip:
+        writer_tgt = ProxyReqStreamWriter(writer_tgt, encode_ip_port(*clt_addr),
+                                          encode_ip_port(global_my_ip, PORT))
+    else:
+        writer_tgt = ProxyReqStreamWriter(writer_tgt)
     reader_tgt = ProxyReqStreamReader(reader_tgt)
 
     return reader_tgt, writer_tgt
 
 
+class ClientConnection:
+    __slots__ = ("id", "user", "dc_idx", "peer_ip", "mode", "started_at", "octets_from_clt",
+                 "octets_to_clt", "writers", "sockets", "relays_alive", "bandwidth_bucket",
+                 "close_reason")
+
+    ids = itertools.count(1)
+
+    def __init__(self, user, dc_idx, peer_ip):
+        self.id = next(self.ids)
+        self.user = user
+        self.dc_idx = dc_idx
+        self.peer_ip = peer_ip
+        if USE_MIDDLE_PROXY:
+            self.mode = "middleproxy"
+        else:
+            self.mode = "direct_fast" if FAST_MODE else "direct"
+        self.started_at = time.time()
+        self.octets_from_clt = 0
+        self.octets_to_clt = 0
+        self.writers = []
+        # the client and the dc sockets
+        self.sockets = (None, None)
+        # the connection is live till both relay halves are finished
+        self.relays_alive = 2
+        self.bandwidth_bucket = None
+        # how the first finished relay half ended
+        self.close_reason = None
+        if CONNECTION_BANDWIDTH_LIMIT:
+            self.bandwidth_bucket = TokenBucket(CONNECTION_BANDWIDTH_LIMIT)
+
+    def get_age(self):
+        return time.time() - self.started_at
+
+    def get_throughput(self):
+        return (self.octets_from_clt + self.octets_to_clt) / max(self.get_age(), 1)
+
+    def to_dict(self):
+        return {
+            "id": self.id, "user": self.user, "dc_idx": self.dc_idx, "peer": self.peer_ip,
+            "mode": self.mode, "age": round(self.get_age(), 3),
+            "octets_from_client": self.octets_from_clt, "octets_to_client": self.octets_to_clt,
+            "throughput": round(self.get_throughput(), 1)
+        }
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class FakeEncryptor:
+    __slots__ = ()
+
+    def encrypt(self, data):
+        return data
+
+
+class FakeDecryptor:
+    __slots__ = ()
+
+    def decrypt(self, data):
+        return data
+
+
+fake_encryptor = FakeEncryptor()
+fake_decryptor = FakeDecryptor()
+
+live_connections = {}
+
+
+class TrafficRecorder:
+    # microseconds since the epoch, connection id, record type, size
+    RECORD = struct.Struct("<QIBI")
+
+    # the size of the start record is the dc index
+    START, FROM_CLT, TO_CLT, END = range(4)
+
+    def __init__(self, path):
+        self.file = open(path, "ab", buffering=TRAFFIC_RECORD_BUFFER)
+
+    def record(self, conn_id, record_type, size=0):
+        self.file.write(self.RECORD.pack(int(time.time() * 1000000), conn_id, record_type, size))
+
+    def close(self):
+        self.file.close()
+
+
+traffic_recorder = None
+
+
+# eventlog.py keeps a copy of the file format, update both
+class EventLog:
+    MAGIC = b"MTPEVLOG"
+    # magic, the number of records written since the file creation
+    HEADER = struct.Struct("<8sQ")
+    # time, connection id, event type, reason, dc index, user, octets from client,
+    # octets to client, duration
+    RECORD = struct.Struct("<dIBBh16sQQf")
+
+    OPEN, REJECTED, CLOSE = range(3)
+    REASONS = ["", "bad", "replayed", "banned", "shed", "user_limit", "timeout",
+               "dc_failed", "client_closed", "dc_closed", "error", "bad_proxy_header"]
+    REASON_CODES = {reason: code for code, reason in enumerate(REASONS)}
+
+    def __init__(self, path, records):
+        self.records = records
+        size = self.HEADER.size + self.RECORD.size * records
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, self.written = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.written = 0
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, 0)
+
+    def record(self, event_type, reason="", conn=None):
+        if conn:
+            user = conn.user.encode()[:16]
+            conn_id, dc_idx = conn.id, conn.dc_idx
+            octets_from_clt, octets_to_clt = conn.octets_from_clt, conn.octets_to_clt
+            duration = conn.get_age()
+        else:
+            user, conn_id, dc_idx, octets_from_clt, octets_to_clt, duration = b"", 0, -1, 0, 0, 0
+
+        # the writes go to the page cache, no syscalls here
+        offset = self.HEADER.size + self.RECORD.size * (self.written % self.records)
+        self.RECORD.pack_into(self.mm, offset, time.time(), conn_id, event_type,
+                              self.REASON_CODES[reason], dc_idx, user, octets_from_clt,
+                              octets_to_clt, duration)
+        self.written += 1
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.written)
+
+    def close(self):
+        self.mm.close()
+
+
+event_log = None
+
+
+async def connect_reader_to_writer(rd, wr, conn, to_clt):
+    user = conn.user
+    try:
+        while True:
+            data = await rd.read(READ_BUF_SIZE)
+            if not data:
+                if not conn.close_reason:
+                    conn.close_reason = "dc_closed" if to_clt else "client_closed"
+                wr.write_eof()
+                await wr.drain()
+                wr.close()
+                return
+            else:
+                update_stats(user, octets=len(data))
+                if traffic_recorder:
+                    traffic_recorder.record(conn.id, TrafficRecorder.TO_CLT if to_clt
+                                            else TrafficRecorder.FROM_CLT, len(data))
+                if to_clt:
+                    conn.octets_to_clt += len(data)
+                else:
+                    conn.octets_from_clt += len(data)
+                await shape_traffic(user, len(data), conn.bandwidth_bucket)
+                wr.write(data)
+                await wr.drain()
+    except (ConnectionResetError, BrokenPipeError, OSError, RuntimeError,
+            AttributeError, asyncio.IncompleteReadError) as e:
+        if not conn.close_reason:
+            conn.close_reason = "error"
+        wr.close()
+        # print(e)
+    finally:
+        update_stats(user, curr_connects_x2=-1)
+        conn.relays_alive -= 1
+        if conn.relays_alive == 0:
+            live_connections.pop(conn.id, None)
+            if traffic_recorder:
+                traffic_recorder.record(conn.id, TrafficRecorder.END)
+            if event_log:
+                event_log.record(EventLog.CLOSE, conn.close_reason or "error", conn)
+
+
+async def connect_to_tg(dc_idx, enc_key_and_iv, clt_addr=None):
+    if not await upstream_connects_limiter.acquire():
+        reject_handshake("shed")
+        return False
+
+    started = time.perf_counter()
+    try:
+        if not USE_MIDDLE_PROXY:
+            if FAST_MODE:
+                tg_data = await do_direct_handshake(dc_idx, dec_key_and_iv=enc_key_and_iv)
+            else:
+                tg_data = await do_direct_handshake(dc_idx)
+        else:
+            tg_data = await do_middleproxy_handshake(dc_idx, clt_addr)
+    finally:
+        add_stage_timing("middleproxy_handshake" if USE_MIDDLE_PROXY else "dc_handshake",
+                         started)
+        upstream_connects_limiter.release()
+
+    if not tg_data and event_log:
+        event_log.record(EventLog.REJECTED, "dc_failed")
+    return tg_data
+
+
 async def handle_client(reader_clt, writer_clt):
-    clt_data = await handle_handshake(reader_clt, writer_clt)
+    peer_ip = get_peer_ip(writer_clt)
+    sock_clt = writer_clt.get_extra_info("socket")
+
+    started = time.perf_counter()
+    try:
+        clt_data = await asyncio.wait_for(handle_handshake(reader_clt, writer_clt),
+                                          CLIENT_HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        reject_handshake("timeout")
+        clt_data = False
+    add_stage_timing("client_handshake", started)
+
     if not clt_data:
         writer_clt.close()
         return
@@ -570,13 +1935,12 @@ async def handle_client(reader_clt, writer_clt):
     
     update_stats(user, connects=1)
 
-    if not USE_MIDDLE_PROXY:
-        if FAST_MODE:
-            tg_data = await do_direct_handshake(dc_idx, dec_key_and_iv=enc_key_and_iv)
-        else:
-            tg_data = await do_direct_handshake(dc_idx)
-    else:
-        tg_data = await do_middleproxy_handshake(dc_idx)
+    tg_data = False
+    try:
+        tg_data = await connect_to_tg(dc_idx, enc_key_and_iv, get_peer_addr(writer_clt))
+    finally:
+        if not tg_data:
+            update_stats(user, curr_connects_x2=-2)
 
     if not tg_data:
         writer_clt.close()
@@ -585,51 +1949,474 @@ async def handle_client(reader_clt, writer_clt):
     reader_tg, writer_tg = tg_data
 
     if not USE_MIDDLE_PROXY and FAST_MODE:
-        class FakeEncryptor:
-            def encrypt(self, data):
-                return data
+        reader_tg.decryptor = fake_decryptor
+        writer_clt.encryptor = fake_encryptor
 
-        class FakeDecryptor:
-            def decrypt(self, data):
-                return data
-
-        reader_tg.decryptor = FakeDecryptor()
-        writer_clt.encryptor = FakeEncryptor()
+    if not USE_MIDDLE_PROXY and FUSED_REENCRYPTION:
+        reader_clt, writer_tg = fuse_reencryption(reader_clt, writer_tg)
+        if not FAST_MODE:
+            reader_tg, writer_clt = fuse_reencryption(reader_tg, writer_clt)
 
     if USE_MIDDLE_PROXY:
         reader_clt = MTProtoCompactFrameStreamReader(reader_clt)
+        if WRITE_COALESCING:
+            writer_clt = CoalescingStreamWriter(writer_clt)
         writer_clt = MTProtoCompactFrameStreamWriter(writer_clt)
 
-    async def connect_reader_to_writer(rd, wr, user):
-        update_stats(user, curr_connects_x2=1)
-        try:
-            while True:
-                data = await rd.read(READ_BUF_SIZE)
-                if not data:
-                    wr.write_eof()
-                    await wr.drain()
-                    wr.close()
-                    return
-                else:
-                    update_stats(user, octets=len(data))
-                    wr.write(data)
-                    await wr.drain()
-        except (ConnectionResetError, BrokenPipeError, OSError,
-                AttributeError, asyncio.streams.IncompleteReadError) as e:
-            wr.close()
-            # print(e)
-        finally:
-            update_stats(user, curr_connects_x2=-1)
+    conn = ClientConnection(user, dc_idx, peer_ip)
+    conn.writers = [writer_clt, writer_tg]
+    conn.sockets = (sock_clt, writer_tg.get_extra_info("socket"))
+    live_connections[conn.id] = conn
+    if traffic_recorder:
+        traffic_recorder.record(conn.id, TrafficRecorder.START, dc_idx)
+    if event_log:
+        event_log.record(EventLog.OPEN, conn=conn)
 
-    asyncio.ensure_future(connect_reader_to_writer(reader_tg, writer_clt, user))
-    asyncio.ensure_future(connect_reader_to_writer(reader_clt, writer_tg, user))
+    asyncio.ensure_future(connect_reader_to_writer(reader_tg, writer_clt, conn, to_clt=True))
+    asyncio.ensure_future(connect_reader_to_writer(reader_clt, writer_tg, conn, to_clt=False))
 
 
 async def handle_client_wrapper(reader, writer):
+    setup_client_socket(writer.get_extra_info("socket"))
+
+    if not await handshakes_limiter.acquire():
+        reject_handshake("shed")
+        writer.close()
+        return
+
     try:
+        if PROXY_PROTOCOL and is_trusted_proxy(get_peer_ip(writer)):
+            try:
+                peername = await asyncio.wait_for(read_proxy_protocol_header(reader),
+                                                  CLIENT_HANDSHAKE_TIMEOUT)
+            except (ValueError, asyncio.TimeoutError):
+                reject_handshake("bad_proxy_header")
+                writer.close()
+                return
+            if peername:
+                writer = PeerAddressStreamWriter(writer, peername)
+
         await handle_client(reader, writer)
     except (asyncio.IncompleteReadError, ConnectionResetError):
         writer.close()
+    finally:
+        handshakes_limiter.release()
+
+
+# the first matching frame from the outermost one wins
+PROFILE_OUTER_STAGES = [
+    ("handle_handshake", "handshake_matching"),
+    ("do_direct_handshake", "dc_handshake"),
+    ("do_middleproxy_handshake", "middleproxy_handshake"),
+]
+
+# the first matching frame from the innermost one wins
+PROFILE_INNER_STAGES = [
+    ("CombinedKeystream", "crypto"),
+    ("CryptoWrappedStream", "crypto"),
+    ("TranscodingStreamReader.transcode", "crypto"),
+    ("MTProto", "framing"),
+    ("ProxyReq", "framing"),
+    ("CoalescingStreamWriter", "framing"),
+    ("shape_traffic", "shaping"),
+    ("FairEgressScheduler", "shaping"),
+]
+
+profile_lock = threading.Lock()
+last_profile = None
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    if hasattr(code, "co_qualname"):
+        return code.co_qualname
+
+    # before python 3.11 the class is known only from the self argument
+    if code.co_argcount and code.co_varnames[0] == "self":
+        obj = frame.f_locals.get("self")
+        if obj is not None:
+            return type(obj).__name__ + "." + code.co_name
+    return code.co_name
+
+
+def classify_stack(frames):
+    innermost = frames[-1]
+    if innermost.f_code.co_name == "select" and "selectors" in innermost.f_code.co_filename:
+        return "idle"
+
+    for frame in frames:
+        name = get_frame_name(frame)
+        for prefix, stage in PROFILE_OUTER_STAGES:
+            if name.startswith(prefix):
+                return stage
+
+    for frame in reversed(frames):
+        if "pyaes" in frame.f_code.co_filename:
+            return "crypto"
+        name = get_frame_name(frame)
+        for prefix, stage in PROFILE_INNER_STAGES:
+            if name.startswith(prefix):
+                return stage
+    return "other"
+
+
+def collect_profile(thread_id, duration, interval):
+    global last_profile
+
+    stacks = collections.Counter()
+    stages = collections.Counter()
+
+    finish_time = time.monotonic() + duration
+    while time.monotonic() < finish_time:
+        frame = sys._current_frames().get(thread_id)
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        del frame
+
+        if frames:
+            stages[classify_stack(frames)] += 1
+            stacks[";".join("%s (%s)" % (get_frame_name(f), os.path.basename(f.f_code.co_filename))
+                            for f in frames)] += 1
+        del frames
+        time.sleep(interval)
+
+    filename = os.path.join(PROFILE_DIR, "profile-%s.folded" % time.strftime("%Y%m%d-%H%M%S"))
+    try:
+        with open(filename, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("%s %d\n" % (stack, count))
+    except OSError as E:
+        print("Failed to write profile:", E, flush=True)
+        filename = None
+
+    samples = sum(stages.values())
+    last_profile = {
+        "file": filename, "samples": samples,
+        "stages": {stage: round(count / max(samples, 1), 4)
+                   for stage, count in stages.most_common()}
+    }
+    print("Profile finished:", json.dumps(last_profile), flush=True)
+
+
+def run_profiler(thread_id, duration, interval):
+    try:
+        collect_profile(thread_id, duration, interval)
+    finally:
+        profile_lock.release()
+
+
+def start_profiling(duration=PROFILE_DURATION):
+    duration = min(max(duration, 0), PROFILE_MAX_DURATION)
+    if not profile_lock.acquire(blocking=False):
+        return False
+
+    thread_id = threading.get_ident()
+    print("Profiling the event loop for %d seconds" % duration, flush=True)
+    try:
+        threading.Thread(target=run_profiler, args=(thread_id, duration, PROFILE_INTERVAL),
+                         daemon=True).start()
+    except RuntimeError:
+        profile_lock.release()
+        raise
+    return True
+
+
+rss_at_start = 0
+last_tracemalloc_snapshot = None
+
+
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_memory_stats():
+    rss = get_rss()
+    conns = len(live_connections)
+    return {
+        "rss": rss, "rss_at_start": rss_at_start, "live_connections": conns,
+        "rss_per_connection": round((rss - rss_at_start) / conns) if conns else 0
+    }
+
+
+def handle_tracemalloc_command(action, n):
+    global last_tracemalloc_snapshot
+
+    if action == "start":
+        tracemalloc.start()
+        last_tracemalloc_snapshot = None
+        return {"tracing": True}
+    elif action == "stop":
+        tracemalloc.stop()
+        last_tracemalloc_snapshot = None
+        return {"tracing": False}
+    elif action != "snapshot":
+        return {"error": "unknown action, use start, snapshot or stop"}
+
+    if not tracemalloc.is_tracing():
+        return {"error": "tracemalloc is not started"}
+
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    total = sum(stat.size for stat in snapshot.statistics("filename"))
+
+    # the diff is against the previous snapshot
+    top = []
+    if last_tracemalloc_snapshot:
+        for stat in snapshot.compare_to(last_tracemalloc_snapshot, "lineno")[:n]:
+            top.append({"site": str(stat.traceback), "size": stat.size,
+                        "size_diff": stat.size_diff, "count": stat.count,
+                        "count_diff": stat.count_diff})
+    else:
+        for stat in snapshot.statistics("lineno")[:n]:
+            top.append({"site": str(stat.traceback), "size": stat.size, "count": stat.count})
+    last_tracemalloc_snapshot = snapshot
+
+    conns = len(live_connections)
+    return {"total": total, "per_connection": round(total / conns) if conns else 0, "top": top}
+
+
+def get_stage_timings():
+    return {stage: {"count": count, "avg_ms": round(total / count * 1000, 3)}
+            for stage, (count, total) in stage_timings.items()}
+
+
+def get_admin_stats():
+    lag_p50, lag_p90, lag_p99, lag_max = get_loop_lag_percentiles()
+    return {
+        "users": {user: dict(stat) for user, stat in stats.items()},
+        "rejected_handshakes": dict(rejected_handshakes),
+        "live_connections": len(live_connections),
+        "handshakes_in_flight": handshakes_limiter.in_flight,
+        "upstream_connects_in_flight": upstream_connects_limiter.in_flight,
+        "loop_lag": {"p50": lag_p50, "p90": lag_p90, "p99": lag_p99, "max": lag_max},
+        "stage_timings": get_stage_timings(),
+        "tcp_info": tcp_info_stats
+    }
+
+
+# set by the admin socket, to take the node out of the balancer before a restart
+draining = False
+
+
+def get_write_buffers_size():
+    size = 0
+    for conn in list(live_connections.values()):
+        for writer in conn.writers:
+            try:
+                size += writer.transport.get_write_buffer_size()
+            except AttributeError:
+                pass
+    return size
+
+
+def get_health():
+    write_buffers_size = get_write_buffers_size()
+    loads = {
+        "loop_lag": get_loop_lag() / OVERLOAD_LOOP_LAG if OVERLOAD_LOOP_LAG else 0,
+        "connections": (len(live_connections) / HEALTH_MAX_CONNECTIONS
+                        if HEALTH_MAX_CONNECTIONS else 0),
+        "handshakes": (handshakes_limiter.in_flight / handshakes_limiter.limit
+                       if handshakes_limiter.limit else 0),
+        "buffers": (write_buffers_size / HEALTH_MAX_BUFFER_BYTES
+                    if HEALTH_MAX_BUFFER_BYTES else 0)
+    }
+    score = max(loads.values())
+
+    if score >= HEALTH_OVERLOADED_SCORE:
+        state = "overloaded"
+    elif draining or score >= HEALTH_DRAINING_SCORE:
+        state = "draining"
+    else:
+        state = "ok"
+
+    return {
+        "state": state, "score": round(score, 3),
+        "loads": {name: round(load, 3) for name, load in loads.items()},
+        "live_connections": len(live_connections),
+        "handshakes_in_flight": handshakes_limiter.in_flight,
+        "write_buffers_size": write_buffers_size,
+        "loop_lag": get_loop_lag()
+    }
+
+
+async def handle_health_client(reader, writer):
+    # http/1.0, /live is always ok while the loop runs, other paths reflect the load
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), CLIENT_HANDSHAKE_TIMEOUT)
+        parts = request_line.split()
+        path = parts[1] if len(parts) > 1 else b"/"
+
+        health = get_health()
+        if path.startswith(b"/live") or health["state"] == "ok":
+            status = b"200 OK"
+        else:
+            status = b"503 Service Unavailable"
+
+        body = json.dumps(health).encode()
+        writer.write(b"HTTP/1.0 " + status + b"\r\nContent-Type: application/json\r\n" +
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
+
+
+def handle_admin_command(cmd):
+    global draining
+
+    cmd_name = cmd.get("cmd")
+
+    if cmd_name == "connections":
+        return {"connections": [conn.to_dict() for conn in live_connections.values()]}
+    elif cmd_name == "top":
+        n = int(cmd.get("n", 10))
+        top = sorted(live_connections.values(), key=lambda c: c.get_throughput(), reverse=True)
+        return {"connections": [conn.to_dict() for conn in top[:n]]}
+    elif cmd_name == "stats":
+        return get_admin_stats()
+    elif cmd_name == "close":
+        conn = live_connections.get(cmd.get("id"))
+        if not conn:
+            return {"error": "no such connection"}
+        conn.close()
+        return {"closed": conn.id}
+    elif cmd_name == "memory":
+        return get_memory_stats()
+    elif cmd_name == "tracemalloc":
+        return handle_tracemalloc_command(cmd.get("action"), int(cmd.get("n", 20)))
+    elif cmd_name == "profile":
+        duration = float(cmd.get("duration", PROFILE_DURATION))
+        return {"started": start_profiling(duration), "last_profile": last_profile}
+    elif cmd_name == "history":
+        return stats_history.query(cmd.get("user"), float(cmd.get("window", 600)),
+                                   bool(cmd.get("points", False)))
+    elif cmd_name == "health":
+        return get_health()
+    elif cmd_name == "drain":
+        draining = bool(cmd.get("on", True))
+        return get_health()
+    return {"error": "unknown command, use connections, top, stats, close, memory, "
+                     "tracemalloc, profile, history, health or drain"}
+
+
+async def handle_admin_client(reader, writer):
+    # one json command per line, one json answer per line
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                cmd = json.loads(line.decode())
+                ans = handle_admin_command(cmd if isinstance(cmd, dict) else {})
+            except (ValueError, TypeError) as E:
+                ans = {"error": str(E)}
+            writer.write(json.dumps(ans).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def loop_lag_monitor():
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_CHECK_PERIOD)
+        lag = loop.time() - started - LOOP_LAG_CHECK_PERIOD
+        loop_lags.append(max(lag, 0))
+
+
+# linux struct tcp_info fields: rtt, rttvar, total_retrans, segs_out, delivery_rate
+TCP_INFO = struct.Struct("<68xII24xI32xI20xQ")
+
+tcp_info_stats = {"dcs": {}, "clients": {}, "client_prefixes": {}, "sampled_at": 0}
+
+
+def get_tcp_info(sock):
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except OSError:
+        return None
+
+    # older kernels give the shorter struct
+    rtt, rttvar, retrans, segs_out, delivery_rate = TCP_INFO.unpack(
+        data.ljust(TCP_INFO.size, b"\0"))
+    return {"rtt": rtt / 1000, "rttvar": rttvar / 1000, "retrans": retrans,
+            "segs_out": segs_out, "delivery_rate": delivery_rate}
+
+
+def get_client_prefix(ip):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return str(ip)
+
+    if addr.version == 6 and addr.ipv4_mapped:
+        addr = addr.ipv4_mapped
+    prefix_len = TCP_INFO_PREFIX_V4 if addr.version == 4 else TCP_INFO_PREFIX_V6
+    return str(ipaddress.ip_network((addr, prefix_len), strict=False))
+
+
+def aggregate_tcp_info(infos):
+    rtts = sorted(info["rtt"] for info in infos)
+    return {
+        "sockets": len(infos),
+        "rtt_p50_ms": get_percentile(rtts, 50),
+        "rtt_p90_ms": get_percentile(rtts, 90),
+        "retrans_ratio": (sum(info["retrans"] for info in infos) /
+                          max(sum(info["segs_out"] for info in infos), 1)),
+        "delivery_rate_avg": sum(info["delivery_rate"] for info in infos) / max(len(infos), 1)
+    }
+
+
+async def tcp_info_sampler():
+    while True:
+        await asyncio.sleep(TCP_INFO_PERIOD)
+
+        dc_infos = collections.defaultdict(list)
+        client_infos = []
+        prefix_infos = collections.defaultdict(list)
+
+        for idx, conn in enumerate(list(live_connections.values())):
+            sock_clt, sock_tg = conn.sockets
+
+            info = get_tcp_info(sock_clt)
+            if info:
+                client_infos.append(info)
+                prefix_infos[get_client_prefix(conn.peer_ip)].append(info)
+
+            info = get_tcp_info(sock_tg)
+            if info:
+                dc_infos[conn.dc_idx].append(info)
+
+            # the syscalls are cheap, but don't hold the loop for too long
+            if idx % 1000 == 999:
+                await asyncio.sleep(0)
+
+        tcp_info_stats["dcs"] = {dc_idx: aggregate_tcp_info(infos)
+                                 for dc_idx, infos in dc_infos.items()}
+        tcp_info_stats["clients"] = aggregate_tcp_info(client_infos)
+        tcp_info_stats["client_prefixes"] = {prefix: aggregate_tcp_info(infos)
+                                             for prefix, infos in prefix_infos.items()}
+        tcp_info_stats["sampled_at"] = time.time()
+
+
+async def stats_history_sampler():
+    while True:
+        stats_history.add_sample()
+        await asyncio.sleep(STATS_HISTORY_PERIOD)
 
 
 async def stats_printer():
@@ -639,12 +2426,137 @@ async def stats_printer():
 
         print("Stats for", time.strftime("%d.%m.%Y %H:%M:%S"))
         for user, stat in stats.items():
-            print("%s: %d connects (%d current), %.2f MB" % (
-                user, stat["connects"], stat["curr_connects_x2"] // 2,
-                stat["octets"] / 1000000))
+            line = "%s: %d connects (%d current), %.2f MB" % (
+                user, stat["connects"], stat["curr_connects_x2"] // 2, stat["octets"] / 1000000)
+            if stats_history.per_user:
+                octets_rate = stats_history.get_rate((user, "octets"), STATS_PRINT_PERIOD)["avg"]
+                line += ", %.3f MB/s lately" % (octets_rate / 1000000)
+            print(line)
+
+        for window in STATS_HISTORY_WINDOWS:
+            history = stats_history.query(window=window)
+            print("Last %d s: %.3f MB/s avg, %.3f MB/s p99, %.2f connects/s, "
+                  "%.2f rejected/s, %d connections max" % (
+                      window, history["octets_per_sec"]["avg"] / 1000000,
+                      history["octets_per_sec"]["p99"] / 1000000,
+                      history["connects_per_sec"]["avg"], history["rejected_per_sec"]["avg"],
+                      history["connections"]["max"]))
+
+        print("Rejected handshakes: %d bad, %d replayed, %d from banned ips, %d shed, "
+              "%d over user limits, %d timed out" % (
+                  rejected_handshakes["bad"], rejected_handshakes["replayed"],
+                  rejected_handshakes["banned"], rejected_handshakes["shed"],
+                  rejected_handshakes["user_limit"], rejected_handshakes["timeout"]))
+
+        memory = get_memory_stats()
+        print("Memory: %.1f MB RSS, %.1f KB per connection" % (
+            memory["rss"] / 1000000, memory["rss_per_connection"] / 1000))
+
+        for stage, timing in sorted(get_stage_timings().items()):
+            print("Stage %s: %d times, %.1f ms avg" % (stage, timing["count"], timing["avg_ms"]))
+
+        if tcp_info_stats["sampled_at"]:
+            for dc_idx, info in sorted(tcp_info_stats["dcs"].items()):
+                print("DC %d link: %d sockets, rtt %.1f ms p50, %.1f ms p90, "
+                      "%.2f%% retransmits" % (
+                          dc_idx + 1, info["sockets"], info["rtt_p50_ms"], info["rtt_p90_ms"],
+                          info["retrans_ratio"] * 100))
+
+            info = tcp_info_stats["clients"]
+            print("Client links: %d sockets, rtt %.1f ms p50, %.1f ms p90, %.2f%% retransmits" % (
+                info["sockets"], info["rtt_p50_ms"], info["rtt_p90_ms"],
+                info["retrans_ratio"] * 100))
+
+            worst = sorted(tcp_info_stats["client_prefixes"].items(),
+                           key=lambda item: item[1]["rtt_p50_ms"], reverse=True)
+            for prefix, info in worst[:TCP_INFO_TOP_PREFIXES]:
+                print("Client network %s: %d sockets, rtt %.1f ms p50, %.2f%% retransmits" % (
+                    prefix, info["sockets"], info["rtt_p50_ms"], info["retrans_ratio"] * 100))
+
+        lag_p50, lag_p90, lag_p99, lag_max = get_loop_lag_percentiles()
+        print("Loop lag: %.1f ms p50, %.1f ms p90, %.1f ms p99, %.1f ms max" % (
+            lag_p50 * 1000, lag_p90 * 1000, lag_p99 * 1000, lag_max * 1000))
         print(flush=True)
 
 
+def parse_proxy_config(text):
+    proxies = collections.defaultdict(list)
+    for line in text.splitlines():
+        parts = line.split("#")[0].strip().rstrip(";").split()
+        if len(parts) != 3 or parts[0] != "proxy_for":
+            continue
+        try:
+            # the media dcs have negative numbers, they are served by the same proxies
+            dc_idx = abs(int(parts[1])) - 1
+            host, port = parts[2].rsplit(":", 1)
+            proxies[dc_idx].append((host.strip("[]"), int(port)))
+        except ValueError:
+            continue
+    return dict(proxies)
+
+
+def apply_proxy_info(proxy_config, proxy_secret):
+    global TG_MIDDLE_PROXIES_V4, PROXY_SECRET
+
+    proxies = parse_proxy_config(proxy_config.decode(errors="replace"))
+    if not proxies or len(proxy_secret) < 16:
+        return False
+
+    TG_MIDDLE_PROXIES_V4 = proxies
+    PROXY_SECRET = proxy_secret
+    return True
+
+
+def get_proxy_info_cache_paths():
+    return (os.path.join(PROXY_INFO_CACHE_DIR, "proxy_config.txt"),
+            os.path.join(PROXY_INFO_CACHE_DIR, "proxy_secret.bin"))
+
+
+def load_cached_proxy_info():
+    config_path, secret_path = get_proxy_info_cache_paths()
+    try:
+        with open(config_path, "rb") as f:
+            proxy_config = f.read()
+        with open(secret_path, "rb") as f:
+            proxy_secret = f.read()
+    except OSError:
+        return False
+    return apply_proxy_info(proxy_config, proxy_secret)
+
+
+def save_proxy_info_to_cache(proxy_config, proxy_secret):
+    for path, data in zip(get_proxy_info_cache_paths(), [proxy_config, proxy_secret]):
+        # write a temporary file first to never leave a half written one
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def fetch_proxy_info():
+    with urllib.request.urlopen(PROXY_CONFIG_URL, timeout=30) as f:
+        proxy_config = f.read()
+    with urllib.request.urlopen(PROXY_SECRET_URL, timeout=30) as f:
+        proxy_secret = f.read()
+    return proxy_config, proxy_secret
+
+
+async def update_proxy_info():
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            proxy_config, proxy_secret = await loop.run_in_executor(None, fetch_proxy_info)
+            if apply_proxy_info(proxy_config, proxy_secret):
+                save_proxy_info_to_cache(proxy_config, proxy_secret)
+                delay = PROXY_INFO_UPDATE_PERIOD
+            else:
+                logger.warning("middleproxy", "Got bad middle proxy info, will retry later")
+                delay = 60
+        except Exception as E:
+            logger.warning("middleproxy", "Failed to update middle proxy info: %s", E)
+            delay = 60
+        await asyncio.sleep(min(delay, PROXY_INFO_UPDATE_PERIOD))
+
+
 def print_tg_info():
     global USE_MIDDLE_PROXY
 
@@ -669,28 +2581,100 @@ def print_tg_info():
         print("{}: tg://proxy?{}".format(user, params_encodeded), flush=True)
 
 
+def try_setup_uvloop():
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print("Found uvloop, using it for optimal performance", flush=True)
+    except ImportError:
+        print("Failed to find uvloop, using default event loop", flush=True)
+
+
 def main():
     init_stats()
 
-    loop = asyncio.get_event_loop()
-    stats_printer_task = asyncio.Task(stats_printer())
-    asyncio.ensure_future(stats_printer_task)
+    if USE_UVLOOP:
+        try_setup_uvloop()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    stats_printer_task = loop.create_task(stats_printer())
+    loop_lag_monitor_task = loop.create_task(loop_lag_monitor())
+    stats_history_sampler_task = loop.create_task(stats_history_sampler())
+    if TCP_INFO_PERIOD:
+        tcp_info_sampler_task = loop.create_task(tcp_info_sampler())
+
+    if USE_MIDDLE_PROXY:
+        load_cached_proxy_info()
+        update_proxy_info_task = loop.create_task(update_proxy_info())
 
-    task_v4 = asyncio.start_server(handle_client_wrapper,
-                                   '0.0.0.0', PORT, loop=loop)
+    task_v4 = asyncio.start_server(handle_client_wrapper, '0.0.0.0', PORT,
+                                   backlog=LISTEN_BACKLOG)
     server_v4 = loop.run_until_complete(task_v4)
+    for sock in server_v4.sockets:
+        setup_listen_socket(sock)
 
     if socket.has_ipv6:
-        task_v6 = asyncio.start_server(handle_client_wrapper,
-                                       '::', PORT, loop=loop)
+        task_v6 = asyncio.start_server(handle_client_wrapper, '::', PORT,
+                                       backlog=LISTEN_BACKLOG)
         server_v6 = loop.run_until_complete(task_v6)
+        for sock in server_v6.sockets:
+            setup_listen_socket(sock)
+
+    global rss_at_start
+    rss_at_start = get_rss()
+
+    global traffic_recorder
+    if TRAFFIC_RECORD_FILE:
+        traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_FILE)
+
+    global event_log
+    if EVENT_LOG_FILE:
+        event_log = EventLog(EVENT_LOG_FILE, EVENT_LOG_RECORDS)
+
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, start_profiling)
+
+    if ADMIN_SOCKET:
+        if os.path.exists(ADMIN_SOCKET):
+            os.unlink(ADMIN_SOCKET)
+        task_admin = asyncio.start_unix_server(handle_admin_client, ADMIN_SOCKET)
+        server_admin = loop.run_until_complete(task_admin)
+
+    if HEALTH_PORT:
+        task_health = asyncio.start_server(handle_health_client, HEALTH_HOST, HEALTH_PORT)
+        server_health = loop.run_until_complete(task_health)
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
+    if HEALTH_PORT:
+        server_health.close()
+        loop.run_until_complete(server_health.wait_closed())
+
+    if ADMIN_SOCKET:
+        server_admin.close()
+        loop.run_until_complete(server_admin.wait_closed())
+        os.unlink(ADMIN_SOCKET)
+
+    if traffic_recorder:
+        traffic_recorder.close()
+
+    if event_log:
+        event_log.close()
+
+    logger.close()
+
     stats_printer_task.cancel()
+    loop_lag_monitor_task.cancel()
+    stats_history_sampler_task.cancel()
+    if TCP_INFO_PERIOD:
+        tcp_info_sampler_task.cancel()
+    if USE_MIDDLE_PROXY:
+        update_proxy_info_task.cancel()
 
     server_v4.close()
     loop.run_until_complete(server_v4.wait_closed())
@@ -51,7 +51,6 @@
 # See the README.md for API details and general information.
 
 
-import copy
 import struct
 
 __all__ = ["AES", "AESModeOfOperationCTR", "AESModeOfOperationCBC", "AESModeOfOperationCFB",
@@ -200,39 +199,17 @@ class AES(object):
                                   self.U3[(tt >>  8) & 0xFF] ^
                                   self.U4[ tt        & 0xFF])
 
+        # Unsigned round key words as tuples for the block loops
+        self._Ke_words = [ tuple(k & 0xFFFFFFFF for k in rk) for rk in self._Ke ]
+        self._Kd_words = [ tuple(k & 0xFFFFFFFF for k in rk) for rk in self._Kd ]
+
     def encrypt(self, plaintext):
         'Encrypt a block of plain text using the AES block cipher.'
 
         if len(plaintext) != 16:
             raise ValueError('wrong block length')
 
-        rounds = len(self._Ke) - 1
-        (s1, s2, s3) = [1, 2, 3]
-        a = [0, 0, 0, 0]
-
-        # Convert plaintext to (ints ^ key)
-        t = [(_compact_word(plaintext[4 * i:4 * i + 4]) ^ self._Ke[0][i]) for i in xrange(0, 4)]
-
-        # Apply round transforms
-        for r in xrange(1, rounds):
-            for i in xrange(0, 4):
-                a[i] = (self.T1[(t[ i          ] >> 24) & 0xFF] ^
-                        self.T2[(t[(i + s1) % 4] >> 16) & 0xFF] ^
-                        self.T3[(t[(i + s2) % 4] >>  8) & 0xFF] ^
-                        self.T4[ t[(i + s3) % 4]        & 0xFF] ^
-                        self._Ke[r][i])
-            t = copy.copy(a)
-
-        # The last round is special
-        result = [ ]
-        for i in xrange(0, 4):
-            tt = self._Ke[rounds][i]
-            result.append((self.S[(t[ i           ] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF)
-            result.append((self.S[(t[(i + s1) % 4] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF)
-            result.append((self.S[(t[(i + s2) % 4] >>  8) & 0xFF] ^ (tt >>  8)) & 0xFF)
-            result.append((self.S[ t[(i + s3) % 4]        & 0xFF] ^  tt       ) & 0xFF)
-
-        return result
+        return list(self.encrypt_blocks(bytes(bytearray(plaintext))))
 
     def decrypt(self, ciphertext):
         'Decrypt a block of cipher text using the AES block cipher.'
@@ -240,33 +217,107 @@ class AES(object):
         if len(ciphertext) != 16:
             raise ValueError('wrong block length')
 
-        rounds = len(self._Kd) - 1
-        (s1, s2, s3) = [3, 2, 1]
-        a = [0, 0, 0, 0]
+        return list(self.decrypt_blocks(bytes(bytearray(ciphertext))))
 
-        # Convert ciphertext to (ints ^ key)
-        t = [(_compact_word(ciphertext[4 * i:4 * i + 4]) ^ self._Kd[0][i]) for i in xrange(0, 4)]
+    def encrypt_blocks(self, plaintext, iv = None):
+        '''Encrypt several concatenated 16 byte blocks, returns bytes.
 
-        # Apply round transforms
-        for r in xrange(1, rounds):
-            for i in xrange(0, 4):
-                a[i] = (self.T5[(t[ i          ] >> 24) & 0xFF] ^
-                        self.T6[(t[(i + s1) % 4] >> 16) & 0xFF] ^
-                        self.T7[(t[(i + s2) % 4] >>  8) & 0xFF] ^
-                        self.T8[ t[(i + s3) % 4]        & 0xFF] ^
-                        self._Kd[r][i])
-            t = copy.copy(a)
-
-        # The last round is special
+           If iv is given, the blocks are chained as in CBC mode.'''
+
+        if len(plaintext) % 16 != 0:
+            raise ValueError('wrong block length')
+
+        if iv is None:
+            chained = False
+            (c0, c1, c2, c3) = (0, 0, 0, 0)
+        else:
+            chained = True
+            (c0, c1, c2, c3) = struct.unpack('>4I', iv)
+
+        # Bind everything used in the inner loop to locals
+        T1, T2, T3, T4, S = self.T1, self.T2, self.T3, self.T4, self.S
+        (k0, k1, k2, k3) = self._Ke_words[0]
+        middle_keys = self._Ke_words[1:-1]
+        (l0, l1, l2, l3) = self._Ke_words[-1]
+
+        words = struct.unpack('>%dI' % (len(plaintext) // 4), plaintext)
         result = [ ]
-        for i in xrange(0, 4):
-            tt = self._Kd[rounds][i]
-            result.append((self.Si[(t[ i           ] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF)
-            result.append((self.Si[(t[(i + s1) % 4] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF)
-            result.append((self.Si[(t[(i + s2) % 4] >>  8) & 0xFF] ^ (tt >>  8)) & 0xFF)
-            result.append((self.Si[ t[(i + s3) % 4]        & 0xFF] ^  tt       ) & 0xFF)
+        append = result.append
+
+        for i in xrange(0, len(words), 4):
+            t0 = words[i    ] ^ c0 ^ k0
+            t1 = words[i + 1] ^ c1 ^ k1
+            t2 = words[i + 2] ^ c2 ^ k2
+            t3 = words[i + 3] ^ c3 ^ k3
+
+            # Apply round transforms
+            for (r0, r1, r2, r3) in middle_keys:
+                (t0, t1, t2, t3) = (
+                    T1[t0 >> 24] ^ T2[(t1 >> 16) & 0xFF] ^ T3[(t2 >> 8) & 0xFF] ^ T4[t3 & 0xFF] ^ r0,
+                    T1[t1 >> 24] ^ T2[(t2 >> 16) & 0xFF] ^ T3[(t3 >> 8) & 0xFF] ^ T4[t0 & 0xFF] ^ r1,
+                    T1[t2 >> 24] ^ T2[(t3 >> 16) & 0xFF] ^ T3[(t0 >> 8) & 0xFF] ^ T4[t1 & 0xFF] ^ r2,
+                    T1[t3 >> 24] ^ T2[(t0 >> 16) & 0xFF] ^ T3[(t1 >> 8) & 0xFF] ^ T4[t2 & 0xFF] ^ r3)
+
+            # The last round is special
+            o0 = ((S[t0 >> 24] << 24) | (S[(t1 >> 16) & 0xFF] << 16) |
+                  (S[(t2 >> 8) & 0xFF] << 8) | S[t3 & 0xFF]) ^ l0
+            o1 = ((S[t1 >> 24] << 24) | (S[(t2 >> 16) & 0xFF] << 16) |
+                  (S[(t3 >> 8) & 0xFF] << 8) | S[t0 & 0xFF]) ^ l1
+            o2 = ((S[t2 >> 24] << 24) | (S[(t3 >> 16) & 0xFF] << 16) |
+                  (S[(t0 >> 8) & 0xFF] << 8) | S[t1 & 0xFF]) ^ l2
+            o3 = ((S[t3 >> 24] << 24) | (S[(t0 >> 16) & 0xFF] << 16) |
+                  (S[(t1 >> 8) & 0xFF] << 8) | S[t2 & 0xFF]) ^ l3
+            append(o0)
+            append(o1)
+            append(o2)
+            append(o3)
+
+            if chained:
+                (c0, c1, c2, c3) = (o0, o1, o2, o3)
+
+        return struct.pack('>%dI' % len(result), *result)
+
+    def decrypt_blocks(self, ciphertext):
+        'Decrypt several concatenated 16 byte blocks, returns bytes.'
+
+        if len(ciphertext) % 16 != 0:
+            raise ValueError('wrong block length')
 
-        return result
+        # Bind everything used in the inner loop to locals
+        T5, T6, T7, T8, Si = self.T5, self.T6, self.T7, self.T8, self.Si
+        (k0, k1, k2, k3) = self._Kd_words[0]
+        middle_keys = self._Kd_words[1:-1]
+        (l0, l1, l2, l3) = self._Kd_words[-1]
+
+        words = struct.unpack('>%dI' % (len(ciphertext) // 4), ciphertext)
+        result = [ ]
+        append = result.append
+
+        for i in xrange(0, len(words), 4):
+            t0 = words[i    ] ^ k0
+            t1 = words[i + 1] ^ k1
+            t2 = words[i + 2] ^ k2
+            t3 = words[i + 3] ^ k3
+
+            # Apply round transforms
+            for (r0, r1, r2, r3) in middle_keys:
+                (t0, t1, t2, t3) = (
+                    T5[t0 >> 24] ^ T6[(t3 >> 16) & 0xFF] ^ T7[(t2 >> 8) & 0xFF] ^ T8[t1 & 0xFF] ^ r0,
+                    T5[t1 >> 24] ^ T6[(t0 >> 16) & 0xFF] ^ T7[(t3 >> 8) & 0xFF] ^ T8[t2 & 0xFF] ^ r1,
+                    T5[t2 >> 24] ^ T6[(t1 >> 16) & 0xFF] ^ T7[(t0 >> 8) & 0xFF] ^ T8[t3 & 0xFF] ^ r2,
+                    T5[t3 >> 24] ^ T6[(t2 >> 16) & 0xFF] ^ T7[(t1 >> 8) & 0xFF] ^ T8[t0 & 0xFF] ^ r3)
+
+            # The last round is special
+            append(((Si[t0 >> 24] << 24) | (Si[(t3 >> 16) & 0xFF] << 16) |
+                    (Si[(t2 >> 8) & 0xFF] << 8) | Si[t1 & 0xFF]) ^ l0)
+            append(((Si[t1 >> 24] << 24) | (Si[(t0 >> 16) & 0xFF] << 16) |
+                    (Si[(t3 >> 8) & 0xFF] << 8) | Si[t2 & 0xFF]) ^ l1)
+            append(((Si[t2 >> 24] << 24) | (Si[(t1 >> 16) & 0xFF] << 16) |
+                    (Si[(t0 >> 8) & 0xFF] << 8) | Si[t3 & 0xFF]) ^ l2)
+            append(((Si[t3 >> 24] << 24) | (Si[(t2 >> 16) & 0xFF] << 16) |
+                    (Si[(t1 >> 8) & 0xFF] << 8) | Si[t0 & 0xFF]) ^ l3)
+
+        return struct.pack('>%dI' % len(result), *result)
 
 
 class Counter(object):
@@ -277,25 +328,32 @@ class Counter(object):
 
     def __init__(self, initial_value = 1):
 
-        # Convert the value into an array of bytes long
-        self._counter = [ ((initial_value >> i) % 256) for i in xrange(128 - 8, -1, -8) ]
+        # The counter is kept as a 128-bit integer
+        self._counter = initial_value & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
 
-    value = property(lambda s: s._counter)
+    value = property(lambda s: [ ((s._counter >> i) & 0xFF) for i in xrange(128 - 8, -1, -8) ])
 
     def increment(self):
         '''Increment the counter (overflow rolls back to 0).'''
 
-        for i in xrange(len(self._counter) - 1, -1, -1):
-            self._counter[i] += 1
+        self._counter = (self._counter + 1) & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
 
-            if self._counter[i] < 256: break
+    def next_blocks(self, count):
+        '''Return the next count counter values as bytes and move past them.'''
 
-            # Carry the one
-            self._counter[i] = 0
+        # Custom counters only promise a working increment
+        if type(self).increment is not Counter.increment:
+            blocks = bytearray()
+            for i in xrange(count):
+                blocks += bytearray(self.value)
+                self.increment()
+            return bytes(blocks)
+
+        value = self._counter
+        self._counter = (value + count) & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+        return b''.join(((value + i) & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF).to_bytes(16, 'big')
+                        for i in xrange(count))
 
-        # Overflow
-        else:
-            self._counter = [ 0 ] * len(self._counter)
 
 
 class AESBlockModeOfOperation(object):
@@ -404,6 +462,40 @@ class AESModeOfOperationCBC(AESBlockModeOfOperation):
 
         return _bytes_to_string(plaintext)
 
+    def encrypt_blocks(self, plaintext):
+        '''Encrypt several concatenated 16 byte blocks in one pass, keeping
+           the chaining state for the next call.'''
+
+        if len(plaintext) % 16 != 0:
+            raise ValueError('plaintext must be a multiple of 16 bytes')
+        if not plaintext:
+            return b''
+
+        iv = bytes(bytearray(self._last_cipherblock))
+        encrypted = self._aes.encrypt_blocks(bytes(bytearray(_string_to_bytes(plaintext))), iv)
+        self._last_cipherblock = list(bytearray(encrypted[-16:]))
+
+        return encrypted
+
+    def decrypt_blocks(self, ciphertext):
+        '''Decrypt several concatenated 16 byte blocks in one pass, keeping
+           the chaining state for the next call.'''
+
+        if len(ciphertext) % 16 != 0:
+            raise ValueError('ciphertext must be a multiple of 16 bytes')
+        if not ciphertext:
+            return b''
+
+        ciphertext = bytes(bytearray(_string_to_bytes(ciphertext)))
+        decrypted = self._aes.decrypt_blocks(ciphertext)
+
+        # Each block is xored with the previous cipher block
+        prev_blocks = bytes(bytearray(self._last_cipherblock)) + ciphertext[:-16]
+        self._last_cipherblock = list(bytearray(ciphertext[-16:]))
+
+        plaintext = int.from_bytes(decrypted, 'big') ^ int.from_bytes(prev_blocks, 'big')
+        return plaintext.to_bytes(len(ciphertext), 'big')
+
 
 
 class AESModeOfOperationCFB(AESSegmentModeOfOperation):
@@ -560,19 +652,21 @@ class AESModeOfOperationCTR(AESStreamModeOfOperation):
             counter = Counter()
 
         self._counter = counter
-        self._remaining_counter = [ ]
+        self._remaining_counter = b''
 
     def encrypt(self, plaintext):
-        while len(self._remaining_counter) < len(plaintext):
-            self._remaining_counter += self._aes.encrypt(self._counter.value)
-            self._counter.increment()
+        plaintext = bytes(bytearray(_string_to_bytes(plaintext)))
 
-        plaintext = _string_to_bytes(plaintext)
+        needed = len(plaintext) - len(self._remaining_counter)
+        if needed > 0:
+            counter_blocks = self._counter.next_blocks((needed + 15) // 16)
+            self._remaining_counter += self._aes.encrypt_blocks(counter_blocks)
 
-        encrypted = [ (p ^ c) for (p, c) in zip(plaintext, self._remaining_counter) ]
-        self._remaining_counter = self._remaining_counter[len(encrypted):]
+        keystream = self._remaining_counter[:len(plaintext)]
+        self._remaining_counter = self._remaining_counter[len(plaintext):]
 
-        return _bytes_to_string(encrypted)
+        encrypted = int.from_bytes(plaintext, 'big') ^ int.from_bytes(keystream, 'big')
+        return encrypted.to_bytes(len(plaintext), 'big')
 
     def decrypt(self, crypttext):
         # AES-CTR is symetric
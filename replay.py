@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Replays the sessions recorded with TRAFFIC_RECORD_FILE through the proxy and a
+# local fake datacenter, keeping the chunk sizes and timings of every session
+#
+# python3 replay.py traffic.rec --scale 10 --speed 2
+
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+
+import mtprotoproxy
+
+Recorder = mtprotoproxy.TrafficRecorder
+
+TAG_LEN = 8
+PAYLOAD = os.urandom(65536)
+
+
+class Session:
+    def __init__(self, started, dc_idx):
+        self.started = started
+        self.dc_idx = dc_idx
+        # (seconds since the session start, size)
+        self.from_clt = []
+        self.to_clt = []
+
+
+def load_sessions(path):
+    sessions = []
+    current = {}
+    with open(path, "rb") as f:
+        data = f.read()
+
+    record_size = Recorder.RECORD.size
+    for pos in range(0, len(data) - record_size + 1, record_size):
+        timestamp, conn_id, record_type, size = Recorder.RECORD.unpack_from(data, pos)
+        timestamp /= 1000000
+        if record_type == Recorder.START:
+            current[conn_id] = Session(timestamp, size)
+            sessions.append(current[conn_id])
+        elif conn_id not in current:
+            continue
+        elif record_type == Recorder.FROM_CLT:
+            current[conn_id].from_clt.append((timestamp - current[conn_id].started, size))
+        elif record_type == Recorder.TO_CLT:
+            current[conn_id].to_clt.append((timestamp - current[conn_id].started, size))
+        elif record_type == Recorder.END:
+            del current[conn_id]
+
+    sessions.sort(key=lambda s: s.started)
+    return sessions
+
+
+async def send_chunks(writer, chunks, speed):
+    started = time.monotonic()
+    for offset, size in chunks:
+        delay = offset / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        while size > 0:
+            writer.write(PAYLOAD[:size])
+            size -= len(PAYLOAD)
+        await writer.drain()
+
+
+class FakeDatacenter:
+    def __init__(self, speed):
+        self.speed = speed
+        # tag -> session
+        self.sessions = {}
+
+    async def handle(self, reader, writer):
+        try:
+            handshake = await reader.readexactly(mtprotoproxy.HANDSHAKE_LEN)
+            key_and_iv = handshake[mtprotoproxy.SKIP_LEN:mtprotoproxy.MAGIC_VAL_POS]
+            decryptor = mtprotoproxy.create_aes_ctr(
+                key=key_and_iv[:mtprotoproxy.KEY_LEN],
+                iv=int.from_bytes(key_and_iv[mtprotoproxy.KEY_LEN:], "big"))
+            decryptor.decrypt(handshake)
+            tag = decryptor.decrypt(await reader.readexactly(TAG_LEN))
+
+            session = self.sessions.pop(tag)
+            sender = asyncio.ensure_future(send_chunks(writer, session.to_clt, self.speed))
+            while await reader.read(65536):
+                pass
+            await sender
+        except (asyncio.IncompleteReadError, ConnectionResetError, KeyError):
+            pass
+        finally:
+            writer.close()
+
+
+class ReplayStats:
+    def __init__(self):
+        self.finished = 0
+        self.failed = 0
+        self.octets = 0
+        # extra delays of the first answers and of the session ends, in seconds
+        self.first_answer_delays = []
+        self.end_delays = []
+
+
+async def replay_session(session, tag, port, secret, speed, stats):
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        stats.failed += 1
+        return
+
+    handshake = bytearray(os.urandom(mtprotoproxy.HANDSHAKE_LEN))
+    handshake[mtprotoproxy.MAGIC_VAL_POS:mtprotoproxy.MAGIC_VAL_POS+4] = (
+        mtprotoproxy.MAGIC_VAL_TO_CHECK)
+    handshake[60:62] = int.to_bytes(session.dc_idx + 1, 2, "little")
+    prekey_and_iv = bytes(handshake[mtprotoproxy.SKIP_LEN:mtprotoproxy.MAGIC_VAL_POS])
+    key = hashlib.sha256(prekey_and_iv[:mtprotoproxy.PREKEY_LEN] + secret).digest()
+    encryptor = mtprotoproxy.create_aes_ctr(
+        key=key, iv=int.from_bytes(prekey_and_iv[mtprotoproxy.PREKEY_LEN:], "big"))
+    encrypted = encryptor.encrypt(bytes(handshake))
+
+    # the payloads are not encrypted, only the tag must reach the datacenter intact
+    writer.write(bytes(handshake[:mtprotoproxy.MAGIC_VAL_POS]) +
+                 encrypted[mtprotoproxy.MAGIC_VAL_POS:] + encryptor.encrypt(tag))
+
+    try:
+        sender = asyncio.ensure_future(send_chunks(writer, session.from_clt, speed))
+        expected = sum(size for offset, size in session.to_clt)
+        received = 0
+        while received < expected:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if not received:
+                first_offset = session.to_clt[0][0] / speed
+                stats.first_answer_delays.append(time.monotonic() - started - first_offset)
+            received += len(data)
+        await sender
+        writer.close()
+    except (ConnectionResetError, BrokenPipeError):
+        stats.failed += 1
+        return
+
+    stats.octets += received
+    if received < expected:
+        stats.failed += 1
+        return
+
+    stats.finished += 1
+    chunks = session.from_clt + session.to_clt
+    duration = max(offset for offset, size in chunks) / speed if chunks else 0
+    stats.end_delays.append(time.monotonic() - started - duration)
+
+
+def print_percentiles(name, values):
+    values = sorted(values)
+    print("%s: %.1f ms p50, %.1f ms p90, %.1f ms p99, %.1f ms max" % (
+        name, *[mtprotoproxy.get_percentile(values, p) * 1000 for p in (50, 90, 99, 100)]))
+
+
+async def replay(sessions, scale, speed, user):
+    stats = ReplayStats()
+    datacenter = FakeDatacenter(speed)
+
+    dc_server = await asyncio.start_server(datacenter.handle, "127.0.0.1", 0)
+    mtprotoproxy.TG_DATACENTERS_V4 = ["127.0.0.1"] * len(mtprotoproxy.TG_DATACENTERS_V4)
+    mtprotoproxy.TG_DATACENTER_PORT = dc_server.sockets[0].getsockname()[1]
+    mtprotoproxy.PREFER_IPV6 = False
+    mtprotoproxy.USE_MIDDLE_PROXY = False
+    mtprotoproxy.init_stats()
+
+    proxy_server = await asyncio.start_server(mtprotoproxy.handle_client_wrapper, "127.0.0.1", 0)
+    port = proxy_server.sockets[0].getsockname()[1]
+    loop_lag_monitor_task = asyncio.ensure_future(mtprotoproxy.loop_lag_monitor())
+
+    secret = bytes.fromhex(mtprotoproxy.USERS[user])
+    tasks = []
+    started = time.monotonic()
+    for idx, session in enumerate(sessions):
+        delay = (session.started - sessions[0].started) / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        for copy_idx in range(scale):
+            tag = int.to_bytes(idx * scale + copy_idx, TAG_LEN, "big")
+            datacenter.sessions[tag] = session
+            tasks.append(asyncio.ensure_future(
+                replay_session(session, tag, port, secret, speed, stats)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+
+    # let the proxy finish closing its connections
+    for i in range(100):
+        if not mtprotoproxy.live_connections:
+            break
+        await asyncio.sleep(0.1)
+
+    loop_lag_monitor_task.cancel()
+    proxy_server.close()
+    dc_server.close()
+
+    print("Replayed %d sessions in %.1f s: %d finished, %d failed, %.2f MB to clients" % (
+        len(tasks), elapsed, stats.finished, stats.failed, stats.octets / 1000000))
+    if stats.first_answer_delays:
+        print_percentiles("First answer delay", stats.first_answer_delays)
+    if stats.end_delays:
+        print_percentiles("Session end delay", stats.end_delays)
+    if mtprotoproxy.loop_lags:
+        print_percentiles("Proxy loop lag", mtprotoproxy.loop_lags)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the proxy")
+    parser.add_argument("record_file", help="the file written with TRAFFIC_RECORD_FILE")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="how many copies of every session to run")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="the time is going that many times faster")
+    parser.add_argument("--user", default=sorted(mtprotoproxy.USERS)[0],
+                        help="the user from config.py to connect as")
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.record_file)
+    if not sessions:
+        print("No sessions in", args.record_file)
+        return
+
+    asyncio.run(replay(sessions, args.scale, args.speed, args.user))
+
+
+if __name__ == "__main__":
+    main()